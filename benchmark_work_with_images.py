@@ -0,0 +1,259 @@
+""" Benchmark delle funzioni di work_with_images su corpus di immagini sintetici.
+
+    Genera offline delle cartelle di immagini (dimensioni e formati diversi) con duplicati esatti e
+    quasi duplicati inseriti, poi misura per diverse dimensioni del corpus:
+      - immagini_uguali / immagini_simili (confronti al secondo)
+      - immagini_uguali_in_cartella per ogni tipo_controllo
+      - su un sottoinsieme di m immagini con m(m-1)/2 <= max_coppie, il confronto a coppie ("simili") come
+        riferimento insieme agli stessi controlli veloci, così le righe sono confrontabili direttamente
+      - immagini_uguali_tensorflow_data su un iteratore a batch sintetico
+    riportando throughput (immagini al secondo), picco di memoria e recall dei duplicati inseriti.
+
+    Ogni misura viene eseguita due volte: una in un processo nuovo (forkserver) per il tempo, senza tracemalloc
+    attivo, e per il picco RSS del processo e dei suoi processi worker; una nel processo corrente con
+    tracemalloc per il picco di memoria allocata da Python/NumPy (che non comprende i worker).
+
+    Uso:
+      python benchmark_work_with_images.py --dimensioni 100 500 2000 --max-coppie 300
+"""
+import argparse
+import itertools
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+import work_with_images as wwi
+
+FORMATI = ["png", "jpg", "bmp"]
+
+def _immagine_casuale(rng : np.random.Generator) -> Image.Image:
+   """Immagine RGB liscia (somma di sinusoidi) di dimensione casuale, così che la ricodifica JPEG
+      produca un quasi duplicato e non rumore."""
+   larghezza, altezza = rng.integers(64, 320, size=2)
+   y, x = np.mgrid[0:altezza, 0:larghezza]
+   canali = []
+   for _ in range(3):
+      fx, fy, fase = rng.uniform(0.005, 0.05), rng.uniform(0.005, 0.05), rng.uniform(0, np.pi)
+      canali.append(np.sin(x * fx + fase) * np.cos(y * fy) * 100 + 128)
+   return Image.fromarray(np.stack(canali, axis=-1).astype(np.uint8))
+
+def genera_corpus(path_directory : str,
+                  n_immagini : int,
+                  frazione_duplicati : float = 0.05,
+                  frazione_simili : float = 0.05,
+                  seed : int = 0
+                 ) -> dict:
+   """
+   Crea in path_directory un corpus di n_immagini immagini sintetiche.
+   Una frazione sono copie esatte di altre immagini (anche in un formato lossless diverso),
+   un'altra frazione sono quasi duplicati (ricodifica JPEG, piccolo ritaglio e variazione di luminosità).
+
+   Output:
+      - duplicati (set): coppie (frozenset di nomi) dei duplicati esatti inseriti
+      - simili (set): coppie (frozenset di nomi) dei quasi duplicati inseriti
+   """
+   rng = np.random.default_rng(seed)
+   n_duplicati = int(n_immagini * frazione_duplicati)
+   n_simili = int(n_immagini * frazione_simili)
+   n_originali = n_immagini - n_duplicati - n_simili
+
+   originali = []
+   for i in range(n_originali):
+      formato = FORMATI[i % len(FORMATI)]
+      nome = f"img_{i:06d}.{formato}"
+      _immagine_casuale(rng).save(os.path.join(path_directory, nome))
+      originali.append(nome)
+
+   lossless = [nome for nome in originali if not nome.endswith(".jpg")]
+
+   duplicati = set()
+   for i in range(n_duplicati):
+      sorgente = lossless[rng.integers(len(lossless))]
+      formato = "png" if sorgente.endswith(".bmp") else "bmp"
+      nome = f"dup_{i:06d}.{formato}"
+      with Image.open(os.path.join(path_directory, sorgente)) as image:
+         image.save(os.path.join(path_directory, nome))
+      duplicati.add(frozenset((sorgente, nome)))
+
+   simili = set()
+   for i in range(n_simili):
+      sorgente = originali[rng.integers(len(originali))]
+      nome = f"sim_{i:06d}.jpg"
+      with Image.open(os.path.join(path_directory, sorgente)) as image:
+         array = np.asarray(image.crop((1, 1, image.width - 1, image.height - 1)), dtype=np.int16)
+      array = np.clip(array + rng.integers(-3, 4), 0, 255).astype(np.uint8)
+      Image.fromarray(array).save(os.path.join(path_directory, nome), quality=85)
+      simili.add(frozenset((sorgente, nome)))
+
+   return {"duplicati": duplicati, "simili": simili}
+
+class DatasetSintetico:
+   """Iteratore a batch con la stessa interfaccia usata da immagini_uguali_tensorflow_data
+      (len, indicizzazione per batch, filenames, batch_size), con immagini in [0, 1]."""
+
+   def __init__(self, path_directory : str, dimensione : tuple = (64, 64), batch_size : int = 32):
+      self.filenames = sorted(os.listdir(path_directory))
+      self.batch_size = batch_size
+      self._path_directory = path_directory
+      self._dimensione = dimensione
+
+   def __len__(self):
+      return -(-len(self.filenames) // self.batch_size)
+
+   def __getitem__(self, i : int):
+      nomi = self.filenames[i * self.batch_size : (i + 1) * self.batch_size]
+      images = np.empty((len(nomi), self._dimensione[1], self._dimensione[0], 3), dtype=np.float32)
+      for k, nome in enumerate(nomi):
+         with Image.open(os.path.join(self._path_directory, nome)) as image:
+            images[k] = np.asarray(image.convert("RGB").resize(self._dimensione), dtype=np.float32) / 255
+      return images, np.zeros(len(nomi))
+
+def _maxrss_mb(chi : int) -> float:
+   """Picco RSS in MB da getrusage (ru_maxrss è in kB su Linux e in byte su macOS)."""
+   maxrss = resource.getrusage(chi).ru_maxrss
+   return maxrss / 2**20 if sys.platform == "darwin" else maxrss / 1024
+
+def _esegui_con_tempo(funzione, args : tuple, kwargs : dict) -> tuple:
+   """Eseguita in un processo nuovo: restituisce risultato, secondi, picco RSS del processo
+      e picco RSS dei processi figli terminati (il maggiore tra i worker)."""
+   # Il processo è avviato dal forkserver, che imposterebbe forkserver anche per i worker di funzione:
+   # tornare al metodo di default della piattaforma così i worker sono figli di questo processo
+   multiprocessing.set_start_method(None, force=True)
+   inizio = time.perf_counter()
+   risultato = funzione(*args, **kwargs)
+   secondi = time.perf_counter() - inizio
+   return risultato, secondi, _maxrss_mb(resource.RUSAGE_SELF), _maxrss_mb(resource.RUSAGE_CHILDREN)
+
+def misura(funzione, *args, **kwargs) -> dict:
+   """Esegue funzione due volte e restituisce risultato, secondi, picco di memoria allocata (tracemalloc,
+      comprende gli array NumPy ma non i processi worker) e picco RSS del processo e dei worker.
+      Il tempo e l'RSS vengono misurati in un processo nuovo senza tracemalloc, così ogni riga ha il proprio
+      picco e non quello dell'intero benchmark; funzione e argomenti devono quindi essere serializzabili."""
+   with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("forkserver")) as executor:
+      risultato, secondi, rss, rss_worker = executor.submit(_esegui_con_tempo, funzione, args, kwargs).result()
+
+   tracemalloc.start()
+   funzione(*args, **kwargs)
+   _, picco = tracemalloc.get_traced_memory()
+   tracemalloc.stop()
+   return {"risultato": risultato, "secondi": secondi, "picco_mb": picco / 2**20,
+           "rss_mb": rss, "rss_worker_mb": rss_worker}
+
+def sottoinsieme(path_directory : str,
+                 path_sottoinsieme : str,
+                 attese : dict,
+                 max_coppie : int) -> dict:
+   """Copia in path_sottoinsieme m immagini di path_directory, con m il massimo per cui m(m-1)/2 <= max_coppie,
+      scegliendo prima le coppie inserite (duplicati e simili) e poi le altre immagini in ordine.
+
+      Output:
+         - duplicati, simili (set): le coppie attese tra le immagini copiate
+   """
+   m = 1
+   while (m + 1) * m // 2 <= max_coppie:
+      m += 1
+   nomi = sorted(os.listdir(path_directory))
+   m = min(m, len(nomi))
+
+   scelti = []
+   for coppia in sorted(sorted(coppia) for coppia in attese["duplicati"] | attese["simili"]):
+      nuovi = [nome for nome in coppia if nome not in scelti]
+      if len(scelti) + len(nuovi) <= m:
+         scelti.extend(nuovi)
+   scelti.extend([nome for nome in nomi if nome not in scelti][:m - len(scelti)])
+
+   for nome in scelti:
+      shutil.copy(os.path.join(path_directory, nome), os.path.join(path_sottoinsieme, nome))
+   scelti = set(scelti)
+   return {tipo: {coppia for coppia in coppie if coppia <= scelti} for tipo, coppie in attese.items()}
+
+def recall(coppie_trovate, coppie_attese : set) -> float:
+   """Frazione delle coppie attese presenti tra quelle trovate (indipendentemente dall'ordine)."""
+   if not coppie_attese:
+      return float("nan")
+   trovate = {frozenset(coppia) for coppia in coppie_trovate}
+   return len(coppie_attese & trovate) / len(coppie_attese)
+
+def _riga(nome : str, n_immagini : int, misure : dict, valore_recall : float) -> str:
+   throughput = n_immagini / misure["secondi"] if misure["secondi"] > 0 else float("inf")
+   return (f"{nome:<32} {n_immagini:>7} {misure['secondi']:>9.3f} {throughput:>11.1f} "
+           f"{misure['picco_mb']:>9.1f} {misure['rss_mb']:>9.1f} {misure['rss_worker_mb']:>13.1f} {valore_recall:>7.3f}")
+
+def _confronti_singoli(funzione, coppie : list, kwargs : dict) -> list:
+   """Confronta ogni coppia di path senza cache, per misurare anche il costo di decodifica."""
+   return [funzione(p1, p2, cache=None, **kwargs) for p1, p2 in coppie]
+
+def benchmark(n_immagini : int, max_coppie : int, n_jobs : int, seed : int = 0) -> list:
+   """Esegue il benchmark su un corpus di n_immagini immagini e restituisce le righe del report."""
+   righe = []
+   cartella = tempfile.mkdtemp(prefix="bench_wwi_")
+   cartella_sottoinsieme = tempfile.mkdtemp(prefix="bench_wwi_sotto_")
+   try:
+      attese = genera_corpus(cartella, n_immagini, seed=seed)
+      path_images = [os.path.join(cartella, nome) for nome in sorted(os.listdir(cartella))]
+
+      # Confronti singoli, senza cache per misurare il costo di decodifica
+      coppie = list(itertools.islice(itertools.combinations(path_images, 2), max_coppie))
+      for nome, funzione, kwargs in [("immagini_uguali", wwi.immagini_uguali, {}),
+                                     ("immagini_simili", wwi.immagini_simili, {"tolleranza": 10.0})]:
+         misure = misura(_confronti_singoli, funzione, coppie, kwargs)
+         righe.append(_riga(f"{nome} ({len(coppie)} coppie)", len(coppie), misure, float("nan")))
+
+      # Scansione della cartella
+      modi = [("duplicati", {}, attese["duplicati"]),
+              ("percettivi", {"distanza_max": 8}, attese["simili"]),
+              ("simili_batch", {"tolleranza": 40.0}, attese["simili"])]
+      if n_jobs > 1:
+         modi.append(("duplicati", {"n_jobs": n_jobs}, attese["duplicati"]))
+         modi.append(("percettivi", {"distanza_max": 8, "n_jobs": n_jobs}, attese["simili"]))
+      for tipo_controllo, kwargs, coppie_attese in modi:
+         wwi.cache_immagini.svuota()
+         misure = misura(wwi.immagini_uguali_in_cartella, cartella, tipo_controllo, **kwargs)
+         nome = f"cartella {tipo_controllo}" + (f" n_jobs={kwargs['n_jobs']}" if "n_jobs" in kwargs else "")
+         righe.append(_riga(nome, n_immagini, misure, recall(misure["risultato"], coppie_attese)))
+
+      # Riferimento: confronto a coppie pixel by pixel su un sottoinsieme con al più max_coppie coppie,
+      # con gli stessi controlli veloci sullo stesso sottoinsieme
+      attese_sottoinsieme = sottoinsieme(cartella, cartella_sottoinsieme, attese, max_coppie)
+      m = len(os.listdir(cartella_sottoinsieme))
+      for tipo_controllo, kwargs, coppie_attese in [("simili", {"tolleranza": 40.0}, attese_sottoinsieme["simili"]),
+                                                    ("simili_batch", {"tolleranza": 40.0}, attese_sottoinsieme["simili"]),
+                                                    ("duplicati", {}, attese_sottoinsieme["duplicati"]),
+                                                    ("percettivi", {"distanza_max": 8}, attese_sottoinsieme["simili"])]:
+         wwi.cache_immagini.svuota()
+         misure = misura(wwi.immagini_uguali_in_cartella, cartella_sottoinsieme, tipo_controllo, **kwargs)
+         nome = f"sotto. {tipo_controllo}" + (" (a coppie)" if tipo_controllo == "simili" else "")
+         righe.append(_riga(nome, m, misure, recall(misure["risultato"], coppie_attese)))
+
+      # Iteratore a batch sintetico confrontato con se stesso
+      dataset = DatasetSintetico(cartella)
+      misure = misura(wwi.immagini_uguali_tensorflow_data, dataset, dataset, verbose=False)
+      righe.append(_riga("tensorflow_data", n_immagini, misure, recall(misure["risultato"], attese["duplicati"])))
+   finally:
+      shutil.rmtree(cartella)
+      shutil.rmtree(cartella_sottoinsieme)
+   return righe
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser(description="Benchmark di work_with_images su corpus sintetici")
+   parser.add_argument("--dimensioni", type=int, nargs="+", default=[100, 500, 2000],
+                       help="numero di immagini dei corpus generati")
+   parser.add_argument("--max-coppie", type=int, default=500,
+                       help="numero massimo di coppie per i confronti singoli e per il riferimento a coppie")
+   parser.add_argument("--n-jobs", type=int, default=1, help="processi per le scansioni parallele")
+   parser.add_argument("--seed", type=int, default=0)
+   args = parser.parse_args()
+
+   print(f"{'funzione':<32} {'n':>7} {'secondi':>9} {'elementi/s':>11} {'picco MB':>9} {'RSS MB':>9} {'RSS worker MB':>13} {'recall':>7}")
+   for n_immagini in args.dimensioni:
+      for riga in benchmark(n_immagini, args.max_coppie, args.n_jobs, args.seed):
+         print(riga)
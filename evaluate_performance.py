@@ -1,13 +1,221 @@
 # Metriche di performance
-from sklearn.metrics import classification_report, accuracy_score, precision_score, recall_score, f1_score,confusion_matrix
 
 import numpy as np
 import pandas as pd
+import os
+from typing import Literal # Per specificare campi multipli nell'input funzione
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+def _matrice_confusione(test_y : np.ndarray,
+                        predizioni: np.ndarray
+                       ) -> tuple:
+   """Costruisce la matrice di confusione con un solo passaggio sui dati.
+      Le classi sono l'unione ordinata dei valori di test_y e predizioni (come in scikit-learn),
+      le coppie (vero, predetto) vengono codificate come vero * k + predetto e contate con np.bincount.
+
+      Output:
+         - labels (np.ndarray): classi ordinate
+         - cm (np.ndarray): matrice k x k, righe valori veri e colonne valori predetti
+   """
+   test_y = np.ravel(test_y)
+   predizioni = np.ravel(predizioni)
+   if len(test_y) != len(predizioni):
+      raise ValueError("test_y e predizioni devono avere la stessa lunghezza")
+
+   labels, codici = np.unique(np.concatenate([test_y, predizioni]), return_inverse=True)
+   k = len(labels)
+   codici = codici.ravel()
+   cm = np.bincount(codici[:len(test_y)] * k + codici[len(test_y):], minlength=k * k).reshape(k, k)
+   return labels, cm
+
+def _conteggi_sparsi(test_y : np.ndarray,
+                     predizioni: np.ndarray
+                    ) -> tuple:
+   """Conteggi della matrice di confusione senza costruirla densa: memoria e tempo dipendono dal numero
+      di campioni e di celle non nulle, non da k x k.
+
+      Output:
+         - labels (np.ndarray): classi ordinate
+         - tp, supporto, predetti (np.ndarray): veri positivi, somme di riga e di colonna per classe
+         - confusione (tuple): matrice in formato COO (righe, colonne, conteggi) con solo le celle non nulle,
+                               ad esempio per scipy.sparse.coo_matrix((conteggi, (righe, colonne)), shape=(k, k))
+   """
+   test_y = np.ravel(test_y)
+   predizioni = np.ravel(predizioni)
+   if len(test_y) != len(predizioni):
+      raise ValueError("test_y e predizioni devono avere la stessa lunghezza")
+
+   labels, codici = np.unique(np.concatenate([test_y, predizioni]), return_inverse=True)
+   k = len(labels)
+   codici = codici.ravel().astype(np.int64)
+   veri, predetti = codici[:len(test_y)], codici[len(test_y):]
+
+   # Celle non nulle: coppie (vero, predetto) distinte con il loro conteggio
+   celle, conteggi = np.unique(veri * k + predetti, return_counts=True)
+   righe, colonne = np.divmod(celle, k)
+
+   tp = np.bincount(righe[righe == colonne], weights=conteggi[righe == colonne], minlength=k).astype(np.int64)
+   supporto = np.bincount(righe, weights=conteggi, minlength=k).astype(np.int64)
+   predetti = np.bincount(colonne, weights=conteggi, minlength=k).astype(np.int64)
+   return labels, tp, supporto, predetti, (righe, colonne, conteggi)
+
+def _dividi(numeratore : np.ndarray, denominatore : np.ndarray) -> np.ndarray:
+   """Divisione elemento per elemento che restituisce 0 dove il denominatore è 0."""
+   numeratore = np.asarray(numeratore, dtype=np.float64)
+   denominatore = np.asarray(denominatore, dtype=np.float64)
+   return np.divide(numeratore, denominatore, out=np.zeros(np.broadcast(numeratore, denominatore).shape),
+                    where=denominatore != 0)
+
+def _metriche_per_classe(tp : np.ndarray,
+                         supporto : np.ndarray,
+                         predetti : np.ndarray,
+                         totale
+                        ) -> dict:
+   """Metriche per classe (one-vs-rest) come operazioni su interi array: tp, supporto (somme di riga)
+      e predetti (somme di colonna) possono avere dimensioni iniziali aggiuntive, ad esempio una per modello
+      o per replica bootstrap, con totale che si allinea ad esse. Le divisioni per zero danno 0.
+
+      Output:
+         - dizionario con TP, FP, FN, TN, recall, specificity, precision, F1Score, accuracy
+   """
+   tp = np.asarray(tp)
+   totale = np.asarray(totale)[..., None] if np.ndim(totale) > 0 else totale
+   fp = predetti - tp # altre classi predette come la classe i
+   fn = supporto - tp # classe i predetta come altre classi
+   tn = totale - (tp + fp + fn)
+
+   recall = _dividi(tp, tp + fn)
+   specificity = _dividi(tn, tn + fp)
+   precision = _dividi(tp, tp + fp)
+   f1_score = 2 * _dividi(precision * recall, precision + recall)
+   accuracy = _dividi(tp + tn, totale * np.ones_like(tp))
+
+   return {"TP": tp, "FP": fp, "FN": fn, "TN": tn,
+           "recall": recall,
+           "specificity": specificity,
+           "precision": precision,
+           "F1Score": f1_score,
+           "accuracy": accuracy}
+
+def _classification_report(labels : np.ndarray,
+                           tp : np.ndarray,
+                           supporto : np.ndarray,
+                           predetti : np.ndarray
+                          ) -> pd.DataFrame:
+   """Report con lo stesso contenuto di pd.DataFrame.from_dict(classification_report(..., output_dict=True))
+      di scikit-learn, calcolato dai conteggi per classe: veri positivi, valori veri (support) e valori predetti.
+      Il dataframe viene costruito direttamente da un array (metriche x colonne), senza passare da dizionari."""
+   precision = _dividi(tp, predetti)
+   recall = _dividi(tp, supporto)
+   f1 = _dividi(2 * tp, supporto + predetti)
+   totale = supporto.sum()
+
+   valori = np.empty((4, len(labels) + 3))
+   valori[:, :len(labels)] = [precision, recall, f1, supporto]
+   valori[:, len(labels)] = _dividi(tp.sum(), totale) # accuracy, uguale su tutte le righe
+   valori[:, len(labels) + 1] = [np.mean(precision), np.mean(recall), np.mean(f1), totale]
+   valori[:, len(labels) + 2] = [np.average(precision, weights=supporto),
+                                 np.average(recall, weights=supporto),
+                                 np.average(f1, weights=supporto),
+                                 totale]
+
+   colonne = ["%s" % label for label in labels] + ["accuracy", "macro avg", "weighted avg"]
+   return pd.DataFrame(valori, index=["precision", "recall", "f1-score", "support"], columns=colonne)
+
+def _indice_positiva(labels : np.ndarray) -> int:
+   """Posizione della classe positiva (codifica 1) per le metriche binarie."""
+   if len(labels) != 2 or 1 not in labels:
+      raise ValueError(f"performance_binary richiede due classi di cui una codificata 1, trovate {list(labels)}")
+   return int(np.flatnonzero(labels == 1)[0])
+
+class RisultatoPerformance:
+   """Risultato leggero di performance_binary / performance_multiclass con raw=True.
+      Contiene solo le classi ed i conteggi per classe in array NumPy; i dataframe df_report e df_report_cm
+      vengono costruiti solo quando si accede alle omonime proprietà (una sola volta, poi restano in memoria).
+      Nei cicli di ricerca degli iperparametri si usano le metriche in array (metriche) e si paga
+      il costo di pandas solo per i risultati che servono.
+
+      Si può usare come il dizionario restituito normalmente: risultato["df_report"], risultato["df_report_cm"].
+   """
+
+   __slots__ = ("tipo", "labels", "tp", "supporto", "predetti", "labels_float", "_df_report", "_df_report_cm")
+
+   def __init__(self,
+                tipo : str,
+                labels : np.ndarray,
+                tp : np.ndarray,
+                supporto : np.ndarray,
+                predetti : np.ndarray,
+                labels_float : dict = {}):
+      self.tipo = tipo
+      self.labels = labels
+      self.tp = tp
+      self.supporto = supporto
+      self.predetti = predetti
+      self.labels_float = labels_float
+      self._df_report = None
+      self._df_report_cm = None
+
+   def __getitem__(self, chiave : str):
+      if chiave not in self.keys():
+         raise KeyError(chiave)
+      return getattr(self, chiave)
+
+   def keys(self):
+      return ["df_report", "df_report_cm"]
+
+   @property
+   def metriche(self) -> np.ndarray:
+      """Metriche in un array strutturato NumPy: per "binary" un record con le colonne di df_report_cm
+         (classe positiva), per "multiclass" un record per classe con le colonne di df_report_cm."""
+      metriche = _metriche_per_classe(self.tp, self.supporto, self.predetti, self.supporto.sum())
+      if self.tipo == "binary":
+         i = _indice_positiva(self.labels)
+         risultato = np.zeros(1, dtype=[(nome, np.float64) for nome in
+                                        ["Accuracy", "Precision", "Recall", "Specificity", "F1-Score"]])
+         risultato["Accuracy"] = _dividi(self.tp.sum(), self.supporto.sum())
+         risultato["Precision"] = metriche["precision"][i]
+         risultato["Recall"] = metriche["recall"][i]
+         risultato["Specificity"] = metriche["specificity"][i]
+         risultato["F1-Score"] = _dividi(2 * self.tp[i], self.supporto[i] + self.predetti[i])
+         return risultato
+
+      nomi = ["recall", "specificity", "precision", "F1Score", "accuracy"]
+      risultato = np.zeros(len(self.labels), dtype=[("class", self.labels.dtype)] + [(nome, np.float64) for nome in nomi])
+      risultato["class"] = self.labels
+      for nome in nomi:
+         risultato[nome] = metriche[nome]
+      return risultato
+
+   def _costruisci(self):
+      if self.tipo == "binary":
+         # Ricostruire la matrice 2 x 2 dai conteggi: righe valori veri, colonne valori predetti
+         cm = np.array([[self.tp[0], self.supporto[0] - self.tp[0]],
+                        [self.supporto[1] - self.tp[1], self.tp[1]]])
+         output = _performance_binary_da_matrice(self.labels, cm, labels_float=self.labels_float)
+      else:
+         output = _performance_multiclass_da_conteggi(self.labels, self.tp, self.supporto, self.predetti,
+                                                     self.labels_float)
+      self._df_report = output["df_report"]
+      self._df_report_cm = output["df_report_cm"]
+
+   @property
+   def df_report(self) -> pd.DataFrame:
+      if self._df_report is None:
+         self._costruisci()
+      return self._df_report
+
+   @property
+   def df_report_cm(self) -> pd.DataFrame:
+      if self._df_report_cm is None:
+         self._costruisci()
+      return self._df_report_cm
 
 def performance_binary(test_y : np.ndarray,
                        predizioni: np.ndarray,
                        verbose : bool = False,
-                       labels_float : dict = {}
+                       labels_float : dict = {},
+                       raw : bool = False
                       ) -> dict : 
    """Funzione per ottenere metriche di performance dati i valori veri per la variabile target y 
       ed i valori predetti dal modello di classificazione.
@@ -18,6 +226,7 @@ def performance_binary(test_y : np.ndarray,
          - verbose (bool) opzionale: avere dei print o no
          - labels_float (dict) opzionale: inserire un dizionario per avere degli output più comprensibili.
                                           Sostituisce i numeri delle classi con i loro nomi   
+         - raw (bool) opzionale: restituire un RisultatoPerformance che costruisce i dataframe solo su richiesta
 
       Output:
          - df_report (pd.DataFrame): metriche di performance per ogni classe e globali
@@ -28,19 +237,39 @@ def performance_binary(test_y : np.ndarray,
       raise TypeError("verbose deve essere un booleano")
 
 
-   # Ottenere report con varie metriche di performance
-   report_scikit_learn = classification_report(test_y, predizioni,output_dict=True)
+   if not isinstance(raw,bool):
+      raise TypeError("raw deve essere un booleano")
+
+   # Matrice di confusione, calcolata una sola volta: tutte le metriche derivano da questa
+   labels, cm = _matrice_confusione(test_y, predizioni)
+
+   if raw:
+      _indice_positiva(labels)
+      return RisultatoPerformance("binary", labels, np.diag(cm), cm.sum(axis=1), cm.sum(axis=0), labels_float)
+
+   return _performance_binary_da_matrice(labels, cm, verbose, labels_float)
+
+def _performance_binary_da_matrice(labels : np.ndarray,
+                                   cm : np.ndarray,
+                                   verbose : bool = False,
+                                   labels_float : dict = {}
+                                  ) -> dict:
+   """Output di performance_binary a partire da classi e matrice di confusione."""
+   tp = np.diag(cm)
 
-   # Trasformare il report di perfomance in un formato più leggibile (pandas dataframe e rinominare classi da numeriche ad categoriche ovvero i nomi originali)
-   df_report = pd.DataFrame.from_dict(report_scikit_learn)
+   # Ottenere report con varie metriche di performance (stesso contenuto di classification_report)
+   report_scikit_learn = _classification_report(labels, tp, cm.sum(axis=1), cm.sum(axis=0))
+
+   # Report in formato più leggibile (pandas dataframe, si rinominano le classi da numeriche ad categoriche ovvero i nomi originali)
+   df_report = report_scikit_learn
 
    if len(labels_float) > 0:
       df_report.rename(columns=labels_float, inplace=True)
    
 
    #-----#
-   # Matrice di confusione
-   cm = confusion_matrix(test_y, predizioni)
+   # Le metriche binarie si riferiscono alla classe positiva (codifica 1)
+   positiva = _indice_positiva(labels)
 
    # Ottenere metriche di performance dalla confusion matrix
    TN, FP, FN, TP = cm.ravel() # Estrazione dei valori dalla confusion matrix
@@ -49,11 +278,11 @@ def performance_binary(test_y : np.ndarray,
    specificity = TN / (TN + FP)
 
    metrics_scikit_learn= {
-         'Accuracy': accuracy_score(test_y, predizioni),
-         'Precision': precision_score(test_y, predizioni),
-         'Recall': recall_score(test_y, predizioni),
+         'Accuracy': float(report_scikit_learn.iloc[0, len(labels)]),
+         'Precision': float(report_scikit_learn.iloc[0, positiva]),
+         'Recall': float(report_scikit_learn.iloc[1, positiva]),
          'Specificity':specificity,
-         'F1-Score': f1_score(test_y, predizioni)
+         'F1-Score': float(report_scikit_learn.iloc[2, positiva])
       }
    df_report_cm = pd.DataFrame.from_dict(metrics_scikit_learn,orient="index").T
    df_report_cm.rename(index={0: "metrics (class 1)"}, inplace=True)
@@ -69,11 +298,49 @@ def performance_binary(test_y : np.ndarray,
             }
    return output
 
+def _media_std_per_indice(df : pd.DataFrame) -> tuple:
+   """Media e deviazione standard (ddof=1) delle righe di df raggruppate per index, senza modificare df.
+      Equivale a df.reset_index().groupby("index").mean() / .std(): i valori vengono portati in un unico
+      array NumPy (righe x colonne) e sommati per gruppo con np.add.at, ignorando i NaN.
+
+      Output:
+         - media, std (pd.DataFrame): una riga per valore dell'index (ordinati), index chiamato "index"
+   """
+   codici, gruppi = pd.factorize(df.index, sort=True)
+   valori = df.to_numpy(dtype=np.float64)
+   validi = ~np.isnan(valori)
+   forma = (len(gruppi), valori.shape[1])
+
+   conteggi = np.zeros(forma)
+   np.add.at(conteggi, codici, validi)
+   somme = np.zeros(forma)
+   np.add.at(somme, codici, np.where(validi, valori, 0))
+   media = np.divide(somme, conteggi, out=np.full(forma, np.nan), where=conteggi > 0)
+
+   scarti = np.zeros(forma)
+   np.add.at(scarti, codici, np.where(validi, valori - media[codici], 0) ** 2)
+   std = np.sqrt(np.divide(scarti, conteggi - 1, out=np.full(forma, np.nan), where=conteggi > 1))
+
+   index = pd.Index(gruppi, name="index")
+   return (pd.DataFrame(media, index=index, columns=df.columns),
+           pd.DataFrame(std, index=index, columns=df.columns))
+
+def _riassunto_fold_report(fold_report : pd.DataFrame) -> tuple:
+   """Media e std per metrica (precision, recall, f1-score) dei df_report di più fold, senza support."""
+   # Rimuovere support, da fastidio (senza modificare il dataframe in input)
+   fold_report = fold_report[fold_report.index != "support"]
+
+   metrics_mean_fold_report, metrics_std_fold_report = _media_std_per_indice(fold_report)
+   metrics_mean_fold_report = metrics_mean_fold_report.reset_index().rename(columns={"index":"metrics"})
+   metrics_std_fold_report = metrics_std_fold_report.reset_index().rename(columns={"index":"metrics"})
+   return metrics_mean_fold_report, metrics_std_fold_report
+
 def performance_binary_fold(fold_report_cm:pd.DataFrame(),
                             fold_report:pd.DataFrame()
                            ) -> dict:
    """
-      Funzione per riassumere (fare media e std) delle metriche di performance di ogni fold
+      Funzione per riassumere (fare media e std) delle metriche di performance di ogni fold.
+      I dataframe in input (concatenazione dei df_report_cm e df_report dei fold) non vengono modificati.
    """
    metrics_mean = fold_report_cm.mean()
    metrics_std = fold_report_cm.std()
@@ -82,19 +349,7 @@ def performance_binary_fold(fold_report_cm:pd.DataFrame(),
       "std (class 1)": metrics_std
    }).T  
 
-
-   # Rimuovere support, da fastidio
-   fold_report.drop(index='support',inplace=True)
-
-   fold_report.reset_index(inplace=True)
-   metrics_mean_fold_report = fold_report.groupby("index").mean()
-   metrics_mean_fold_report.reset_index(inplace=True)
-   metrics_mean_fold_report = metrics_mean_fold_report.rename(columns={"index":"metrics"})
-
-   metrics_std_fold_report = fold_report.groupby("index").std()
-   metrics_std_fold_report.reset_index(inplace=True)
-   metrics_std_fold_report = metrics_std_fold_report.rename(columns={"index":"metrics"})
-
+   metrics_mean_fold_report, metrics_std_fold_report = _riassunto_fold_report(fold_report)
 
    output = {"risultati_fold_report_cm":risultati_fold_report_cm,
              "metrics_mean_fold_report":metrics_mean_fold_report,
@@ -107,7 +362,9 @@ def performance_binary_fold(fold_report_cm:pd.DataFrame(),
 def performance_multiclass(test_y : np.ndarray,
                        predizioni: np.ndarray,
                        verbose : bool = False,
-                       labels_float : dict = {}
+                       labels_float : dict = {},
+                       sparsa : bool = False,
+                       raw : bool = False
                       ) -> dict : 
    """Funzione per ottenere metriche di performance dati i valori veri per la variabile target y 
       ed i valori predetti dal modello di classificazione.
@@ -118,10 +375,14 @@ def performance_multiclass(test_y : np.ndarray,
          - verbose (bool) opzionale: avere dei print o no
          - labels_float (dict) opzionale: inserire un dizionario per avere degli output più comprensibili.
                                           Sostituisce i numeri delle classi con i loro nomi   
+         - sparsa (bool) opzionale: non costruire la matrice di confusione densa k x k ma solo le celle
+                                    non nulle, per problemi con moltissime classi
+         - raw (bool) opzionale: restituire un RisultatoPerformance che costruisce i dataframe solo su richiesta
 
       Output:
          - df_report (pd.DataFrame): metriche di performance per ogni classe e globali
          - df_report_cm (pd.DataFrame): metriche di performance per la classe positiva (codifica 1)
+         - confusione_sparsa (tuple) solo con sparsa: matrice di confusione COO (righe, colonne, conteggi)
 
       Ottenere le metriche aggiuntive dalla confusion matrix preferito a  classification_report in 
       questo modo si può calcolare anche la sensitivity.
@@ -146,57 +407,74 @@ def performance_multiclass(test_y : np.ndarray,
       raise TypeError("verbose deve essere un booleano")
 
 
-   # Ottenere report con varie metriche di performance
-   report_scikit_learn = classification_report(test_y, predizioni,output_dict=True)
+   if not isinstance(sparsa,bool):
+      raise TypeError("sparsa deve essere un booleano")
 
-   # Trasformare il report di perfomance in un formato più leggibile (pandas dataframe e rinominare classi da numeriche ad categoriche ovvero i nomi originali)
-   df_report = pd.DataFrame.from_dict(report_scikit_learn)
+   if not isinstance(raw,bool):
+      raise TypeError("raw deve essere un booleano")
 
- 
-   
-   # Inizializzare il dataframe ove verranno salvate 
-   metriche = pd.DataFrame()
+   if raw:
+      if sparsa:
+         labels, tp, supporto, predetti, _ = _conteggi_sparsi(test_y, predizioni)
+      else:
+         labels, ConfusioMatrix = _matrice_confusione(test_y, predizioni)
+         tp, supporto, predetti = np.diag(ConfusioMatrix), ConfusioMatrix.sum(axis=1), ConfusioMatrix.sum(axis=0)
+      return RisultatoPerformance("multiclass", labels, tp, supporto, predetti, labels_float)
 
-   # Total number of samples
-   ConfusioMatrix = confusion_matrix(test_y, predizioni)
-   total_samples = np.sum(ConfusioMatrix)  
+   if sparsa:
+      # Solo le celle non nulle della matrice di confusione e le somme per classe
+      labels, tp, supporto, predetti, confusione_sparsa = _conteggi_sparsi(test_y, predizioni)
+      output = _performance_multiclass_da_conteggi(labels, tp, supporto, predetti, labels_float)
+      output["confusione_sparsa"] = confusione_sparsa
+      return output
 
-   # region Calcolare le metriche
-   # Iterare per  ogni riga della confusion matrix, quindi per ogni classe 
-   for i in range(len(ConfusioMatrix)):
-      TP = ConfusioMatrix[i, i]  # True Positives for class i
-      FP = ConfusioMatrix[:, i].sum() - TP  # False Positives for class i (other classes predicted as class i)
-      FN = ConfusioMatrix[i, :].sum() - TP  # False Negatives for class i (class i predicted as other classes)
-      TN = total_samples - (TP + FP + FN)  # True Negatives for class i
+   # Matrice di confusione, calcolata una sola volta
+   labels, ConfusioMatrix = _matrice_confusione(test_y, predizioni)
 
-      # Calcolare le metriche, i nomi si spiegano da soli, inoltre mettere dei check aggiuntivi sulla divisione per zero
-      specificity = TN / (TN + FP) if (TN + FP) > 0 else 0
-      precision = TP / (TP + FP) if (TP + FP) > 0 else 0
-      recall = TP  / (TP+FN) if (TP + FN) > 0 else 0
-      f1_score = 2 * ((precision *recall)/(precision  + recall))  if (precision  + recall) > 0 else 0
+   return _performance_multiclass_da_matrice(labels, ConfusioMatrix, labels_float)
 
+def _performance_multiclass_da_matrice(labels : np.ndarray,
+                                       ConfusioMatrix : np.ndarray,
+                                       labels_float : dict = {}
+                                      ) -> dict:
+   """Output di performance_multiclass a partire da classi e matrice di confusione."""
+   return _performance_multiclass_da_conteggi(labels,
+                                              np.diag(ConfusioMatrix),
+                                              ConfusioMatrix.sum(axis=1),
+                                              ConfusioMatrix.sum(axis=0),
+                                              labels_float)
 
-      # Un check per vedere se i risultati corrispondono
-      if TP+TN+FP+FN != total_samples:
-         raise ValueError("Error of some kind occurred")
+def _performance_multiclass_da_conteggi(labels : np.ndarray,
+                                        tp : np.ndarray,
+                                        supporto : np.ndarray,
+                                        predetti : np.ndarray,
+                                        labels_float : dict = {}
+                                       ) -> dict:
+   """Output di performance_multiclass a partire dai conteggi per classe: veri positivi,
+      valori veri (somme di riga) e valori predetti (somme di colonna) della matrice di confusione."""
+   total_samples = np.sum(supporto)
 
-      # Calcolare l'accuracy
-      accuracy = (TP+TN)/(total_samples)
+   # Ottenere report con varie metriche di performance (stesso contenuto di classification_report)
+   report_scikit_learn = _classification_report(labels, tp, supporto, predetti)
 
-      # Salvare le metriche ottenute per la classe i-esima
-      row = pd.DataFrame({ "recall":[recall],
-                           "specificity":[specificity],
-                           "precision":[precision],
-                           "F1Score":[f1_score],
-                           "accuracy":[accuracy]})
+   # Report in formato più leggibile (pandas dataframe, si rinominano le classi da numeriche ad categoriche ovvero i nomi originali)
+   df_report = report_scikit_learn
 
+   # region Calcolare le metriche
+   # Tutte le classi insieme: diagonale, somme di riga e di colonna della confusion matrix
+   metriche_classi = _metriche_per_classe(tp, supporto, predetti, total_samples)
+
+   # Un check per vedere se i risultati corrispondono
+   if np.any(metriche_classi["TP"] + metriche_classi["TN"] + metriche_classi["FP"] + metriche_classi["FN"] != total_samples):
+      raise ValueError("Error of some kind occurred")
 
-      # Salvare  le metriche nel dataframe principale
-      metriche=pd.concat([metriche,row])
+   # Salvare le metriche ottenute per ogni classe
+   metriche = pd.DataFrame({nome: metriche_classi[nome]
+                            for nome in ["recall", "specificity", "precision", "F1Score", "accuracy"]})
    # endregion
 
-   # Assegnare gli index al dataframe, senza questa riga erano tutti zeri.
-   metriche.index = [float(i) for i in range(len(ConfusioMatrix))]
+   # Assegnare gli index al dataframe, il numero della classe in float.
+   metriche.index = [float(i) for i in range(len(labels))]
 
 
    if len(labels_float) > 0:
@@ -212,31 +490,14 @@ def performance_multiclass_fold(fold_report_cm:pd.DataFrame(),
                             fold_report:pd.DataFrame()
                            ) -> dict:
    """
-      Funzione per riassumere (fare media e std) delle metriche di performance di ogni fold
+      Funzione per riassumere (fare media e std) delle metriche di performance di ogni fold.
+      I dataframe in input (concatenazione dei df_report_cm e df_report dei fold) non vengono modificati.
    """
-   fold_report_cm.reset_index(inplace=True)
-
-   metrics_mean = fold_report_cm.groupby("index").mean()
-   metrics_mean.reset_index(inplace=True)
-   metrics_mean.rename(columns={"index":"class"},inplace=True)
-
-   metrics_std = fold_report_cm.groupby("index").std()
-   metrics_std.reset_index(inplace=True)
-   metrics_std.rename(columns={"index":"class"},inplace=True)
-
-
-   # Rimuovere support, da fastidio
-   fold_report.drop(index='support',inplace=True)
-
-   fold_report.reset_index(inplace=True)
-   metrics_mean_fold_report = fold_report.groupby("index").mean()
-   metrics_mean_fold_report.reset_index(inplace=True)
-   metrics_mean_fold_report = metrics_mean_fold_report.rename(columns={"index":"metrics"})
-
-   metrics_std_fold_report = fold_report.groupby("index").std()
-   metrics_std_fold_report.reset_index(inplace=True)
-   metrics_std_fold_report = metrics_std_fold_report.rename(columns={"index":"metrics"})
+   metrics_mean, metrics_std = _media_std_per_indice(fold_report_cm)
+   metrics_mean = metrics_mean.reset_index().rename(columns={"index":"class"})
+   metrics_std = metrics_std.reset_index().rename(columns={"index":"class"})
 
+   metrics_mean_fold_report, metrics_std_fold_report = _riassunto_fold_report(fold_report)
 
    output = {
             "metrics_mean_fold_report_cm":metrics_mean,
@@ -246,4 +507,565 @@ def performance_multiclass_fold(fold_report_cm:pd.DataFrame(),
             }
 
 
-   return output
\ No newline at end of file
+   return output
+
+class AccumulatoreMetriche:
+   """Accumulatore delle metriche di performance per dataset che non stanno in memoria o predizioni divise in shard.
+      Mantiene solo le classi viste e la matrice di confusione (memoria costante rispetto al numero di campioni):
+         - update(y_true, y_pred): aggiunge un batch di valori veri e predetti
+         - merge(other): aggiunge i conteggi di un altro accumulatore (es. calcolato da un altro worker)
+         - performance_binary / performance_multiclass: stessi output delle omonime funzioni sull'intero dataset
+
+      Esempio:
+         accumulatore = AccumulatoreMetriche()
+         for y_batch, pred_batch in batch:
+            accumulatore.update(y_batch, pred_batch)
+         output = accumulatore.performance_multiclass()
+   """
+
+   def __init__(self):
+      self.labels = None # classi ordinate
+      self.cm = np.zeros((0, 0), dtype=np.int64)
+
+   def __len__(self):
+      """Numero di campioni accumulati."""
+      return int(self.cm.sum())
+
+   def _aggiungi(self, labels : np.ndarray, cm : np.ndarray):
+      """Somma una matrice di confusione con le sue classi, allargando la matrice se ci sono classi nuove."""
+      if self.labels is None:
+         self.labels = labels
+         self.cm = cm.astype(np.int64, copy=True)
+         return
+
+      unione = np.union1d(self.labels, labels)
+      if len(unione) != len(self.labels):
+         nuova_cm = np.zeros((len(unione), len(unione)), dtype=np.int64)
+         indici = np.searchsorted(unione, self.labels)
+         nuova_cm[np.ix_(indici, indici)] = self.cm
+         self.labels, self.cm = unione, nuova_cm
+
+      indici = np.searchsorted(self.labels, labels)
+      self.cm[np.ix_(indici, indici)] += cm
+
+   def update(self, y_true : np.ndarray, y_pred : np.ndarray):
+      """Aggiunge un batch di valori veri e predetti."""
+      labels, cm = _matrice_confusione(y_true, y_pred)
+      self._aggiungi(labels, cm)
+      return self
+
+   def merge(self, other):
+      """Aggiunge i conteggi di un altro AccumulatoreMetriche."""
+      if not isinstance(other, AccumulatoreMetriche):
+         raise TypeError("other deve essere un AccumulatoreMetriche")
+      if other.labels is not None:
+         self._aggiungi(other.labels, other.cm)
+      return self
+
+   def _controlla_dati(self):
+      if self.labels is None:
+         raise ValueError("Nessun dato accumulato, chiamare prima update")
+
+   def performance_binary(self,
+                          verbose : bool = False,
+                          labels_float : dict = {}
+                         ) -> dict:
+      """Stesso output di performance_binary sui dati accumulati."""
+      if not isinstance(verbose,bool):
+         raise TypeError("verbose deve essere un booleano")
+      self._controlla_dati()
+      return _performance_binary_da_matrice(self.labels, self.cm, verbose, labels_float)
+
+   def performance_multiclass(self,
+                              verbose : bool = False,
+                              labels_float : dict = {}
+                             ) -> dict:
+      """Stesso output di performance_multiclass sui dati accumulati."""
+      if not isinstance(verbose,bool):
+         raise TypeError("verbose deve essere un booleano")
+      self._controlla_dati()
+      return _performance_multiclass_da_matrice(self.labels, self.cm, labels_float)
+
+
+class _StatoWelford:
+   """Media e varianza online (algoritmo di Welford) cella per cella di dataframe con index e colonne
+      che possono cambiare tra un aggiornamento e l'altro (ad esempio classi assenti in un fold). I NaN vengono ignorati."""
+
+   def __init__(self):
+      self.index = None
+      self.columns = None
+      self.n = self.media = self.m2 = None
+
+   def aggiorna(self, df : pd.DataFrame):
+      if self.index is None:
+         self.index, self.columns = df.index.unique(), df.columns
+         forma = (len(self.index), len(self.columns))
+         self.n, self.media, self.m2 = np.zeros(forma), np.zeros(forma), np.zeros(forma)
+
+      index = self.index.append(df.index.unique().difference(self.index, sort=False))
+      columns = self.columns.append(df.columns.difference(self.columns, sort=False))
+      if len(index) != len(self.index) or len(columns) != len(self.columns):
+         # Allargare lo stato con le nuove righe/colonne, a conteggio zero
+         righe = index.get_indexer(self.index)
+         colonne = columns.get_indexer(self.columns)
+         for nome in ["n", "media", "m2"]:
+            nuovo = np.zeros((len(index), len(columns)))
+            nuovo[np.ix_(righe, colonne)] = getattr(self, nome)
+            setattr(self, nome, nuovo)
+         self.index, self.columns = index, columns
+
+      for _, riga in df.groupby(level=0, sort=False):
+         x = riga.reindex(columns=self.columns).to_numpy(dtype=np.float64)
+         i = self.index.get_indexer(riga.index[:1])[0]
+         for valori in x:
+            validi = ~np.isnan(valori)
+            self.n[i] += validi
+            delta = np.where(validi, valori - self.media[i], 0)
+            self.media[i] += np.divide(delta, self.n[i], out=np.zeros_like(delta), where=validi)
+            self.m2[i] += np.where(validi, delta * (valori - self.media[i]), 0)
+
+   def risultati(self) -> tuple:
+      """Media e std (ddof=1) come dataframe, con l'index ordinato e chiamato "index"."""
+      media = np.where(self.n > 0, self.media, np.nan)
+      std = np.sqrt(np.divide(self.m2, self.n - 1, out=np.full(self.n.shape, np.nan), where=self.n > 1))
+      index = pd.Index(self.index, name="index")
+      return (pd.DataFrame(media, index=index, columns=self.columns).sort_index(),
+              pd.DataFrame(std, index=index, columns=self.columns).sort_index())
+
+class AggregatoreFold:
+   """Aggregatore online delle metriche dei fold di una cross validation: ogni fold viene aggiunto appena
+      calcolato e media/std si aggiornano con l'algoritmo di Welford, senza tenere in memoria
+      o concatenare i report dei singoli fold. Gli output di performance_binary / performance_multiclass
+      non vengono modificati.
+
+      Esempio:
+         aggregatore = AggregatoreFold()
+         for train, test in folds:
+            aggregatore.aggiungi(performance_multiclass(y[test], modello.predict(X[test])))
+         riassunto = aggregatore.performance_multiclass_fold()
+   """
+
+   def __init__(self):
+      self.n_fold = 0
+      self._report = _StatoWelford()
+      self._report_cm = _StatoWelford()
+
+   def aggiungi(self, output_performance : dict):
+      """Aggiunge l'output (dict con df_report e df_report_cm) di performance_binary o performance_multiclass per un fold."""
+      df_report = output_performance["df_report"]
+      self._report.aggiorna(df_report[df_report.index != "support"])
+      self._report_cm.aggiorna(output_performance["df_report_cm"])
+      self.n_fold += 1
+      return self
+
+   def _riassunto_report(self) -> tuple:
+      if self.n_fold == 0:
+         raise ValueError("Nessun fold aggiunto, chiamare prima aggiungi")
+      media, std = self._report.risultati()
+      return (media.reset_index().rename(columns={"index":"metrics"}),
+              std.reset_index().rename(columns={"index":"metrics"}))
+
+   def performance_binary_fold(self) -> dict:
+      """Stesso output di performance_binary_fold sui fold aggiunti."""
+      metrics_mean_fold_report, metrics_std_fold_report = self._riassunto_report()
+      media, std = self._report_cm.risultati()
+      risultati_fold_report_cm = pd.DataFrame({
+         "mean (class 1)": media.iloc[0],
+         "std (class 1)": std.iloc[0]
+      }).T
+      risultati_fold_report_cm.columns.name = None
+
+      return {"risultati_fold_report_cm":risultati_fold_report_cm,
+              "metrics_mean_fold_report":metrics_mean_fold_report,
+              "metrics_std_fold_report":metrics_std_fold_report
+             }
+
+   def performance_multiclass_fold(self) -> dict:
+      """Stesso output di performance_multiclass_fold sui fold aggiunti."""
+      metrics_mean_fold_report, metrics_std_fold_report = self._riassunto_report()
+      media, std = self._report_cm.risultati()
+
+      return {"metrics_mean_fold_report_cm":media.reset_index().rename(columns={"index":"class"}),
+              "metrics_std_fold_report_cm":std.reset_index().rename(columns={"index":"class"}),
+              "metrics_mean_fold_report":metrics_mean_fold_report,
+              "metrics_std_fold_report":metrics_std_fold_report
+             }
+
+
+def _seleziona(dati, indici):
+   """Righe indici di un array NumPy o di un oggetto pandas (posizionali)."""
+   if hasattr(dati, "iloc"):
+      return dati.iloc[indici]
+   return np.asarray(dati)[indici]
+
+def _valuta_fold(X, y, train, test, fit_predict, tipo : str, labels_float : dict) -> dict:
+   """Addestra e valuta un singolo fold (eseguita anche nei worker del pool)."""
+   predizioni = fit_predict(_seleziona(X, train), _seleziona(y, train), _seleziona(X, test))
+   y_test = np.asarray(_seleziona(y, test))
+   if tipo == "binary":
+      return performance_binary(y_test, np.asarray(predizioni), labels_float=labels_float)
+   return performance_multiclass(y_test, np.asarray(predizioni), labels_float=labels_float)
+
+# Dati dei processi worker di performance_cross_validation, impostati una sola volta da _inizializza_worker_fold
+_dati_worker_fold = None
+
+def _inizializza_worker_fold(X, y, fit_predict, tipo : str, labels_float : dict):
+   global _dati_worker_fold
+   _dati_worker_fold = (X, y, fit_predict, tipo, labels_float)
+
+def _valuta_fold_worker(train, test) -> dict:
+   """Valuta un fold nei processi worker: dal processo principale arrivano solo gli indici del fold."""
+   X, y, fit_predict, tipo, labels_float = _dati_worker_fold
+   return _valuta_fold(X, y, train, test, fit_predict, tipo, labels_float)
+
+def performance_cross_validation(X,
+                                 y,
+                                 folds,
+                                 fit_predict,
+                                 tipo : Literal["binary", "multiclass"] = "binary",
+                                 n_jobs : int = 1,
+                                 backend : Literal["thread", "process"] = "thread",
+                                 labels_float : dict = {}
+                                ) -> dict:
+   """Funzione per valutare un modello in cross validation: per ogni fold addestra e predice, calcola
+      le metriche con performance_binary / performance_multiclass e le riassume con le funzioni *_fold.
+      I fold vengono eseguiti su un pool di thread o di processi, i risultati sono sempre nell'ordine dei fold.
+      Con il pool di processi X, y e fit_predict vengono inviati una sola volta ad ogni worker (initializer del pool)
+      e per ogni fold si inviano solo gli indici train / test.
+
+      Prende in input:
+         - X, y: dati e variabile target (array NumPy o oggetti pandas, indicizzati per posizione)
+         - folds: iterabile di coppie (indici train, indici test), ad esempio KFold(...).split(X)
+         - fit_predict: funzione fit_predict(X_train, y_train, X_test) che restituisce le predizioni su X_test,
+                        con backend "process" deve essere definita a livello di modulo (picklable)
+         - tipo ("binary", "multiclass"): quali funzioni di performance usare
+         - n_jobs (int): numero di fold eseguiti in parallelo, -1 per usare tutti i core
+         - backend ("thread", "process"): tipo di pool, i thread bastano se il modello rilascia il GIL
+         - labels_float (dict) opzionale: nomi delle classi, come in performance_binary / performance_multiclass
+
+      Output:
+         - fold (list): output di performance_binary / performance_multiclass per ogni fold
+         - le chiavi di output di performance_binary_fold / performance_multiclass_fold
+   """
+   if tipo not in ["binary", "multiclass"]:
+      raise ValueError('tipo deve essere "binary" o "multiclass"')
+
+   if backend not in ["thread", "process"]:
+      raise ValueError('backend deve essere "thread" o "process"')
+
+   if not isinstance(n_jobs,int) or n_jobs == 0 or n_jobs < -1:
+      raise ValueError("n_jobs deve essere un intero positivo oppure -1")
+   if n_jobs == -1:
+      n_jobs = os.cpu_count() or 1
+
+   folds = list(folds)
+   train_fold = [train for train, _ in folds]
+   test_fold = [test for _, test in folds]
+
+   # map restituisce i risultati nell'ordine dei fold
+   if n_jobs == 1:
+      risultati_fold = [_valuta_fold(X, y, train, test, fit_predict, tipo, labels_float) for train, test in folds]
+   elif backend == "thread":
+      with ThreadPoolExecutor(max_workers=min(n_jobs, len(folds))) as executor:
+         risultati_fold = list(executor.map(lambda train, test: _valuta_fold(X, y, train, test, fit_predict, tipo, labels_float),
+                                            train_fold, test_fold))
+   else:
+      with ProcessPoolExecutor(max_workers=min(n_jobs, len(folds)),
+                               initializer=_inizializza_worker_fold,
+                               initargs=(X, y, fit_predict, tipo, labels_float)) as executor:
+         risultati_fold = list(executor.map(_valuta_fold_worker, train_fold, test_fold))
+
+   fold_report_cm = pd.concat([risultati["df_report_cm"] for risultati in risultati_fold])
+   fold_report = pd.concat([risultati["df_report"] for risultati in risultati_fold])
+
+   if tipo == "binary":
+      output = performance_binary_fold(fold_report_cm, fold_report)
+   else:
+      output = performance_multiclass_fold(fold_report_cm, fold_report)
+
+   output["fold"] = risultati_fold
+   return output
+
+
+def performance_bootstrap(test_y : np.ndarray,
+                          predizioni: np.ndarray,
+                          tipo : Literal["binary", "multiclass"] = "binary",
+                          n_bootstrap : int = 10000,
+                          livello : float = 0.95,
+                          seed : int = None,
+                          dimensione_blocco : int = None,
+                          memoria_blocco : int = 256 * 1024**2,
+                          labels_float : dict = {}
+                         ) -> dict:
+   """Funzione per ottenere intervalli di confidenza bootstrap (percentili) delle metriche di performance.
+      Invece di ricampionare i dati e ricalcolare le metriche n_bootstrap volte, ricampiona direttamente
+      le celle della matrice di confusione con estrazioni multinomiali (equivalente a ricampionare le coppie
+      vero/predetto con reinserimento) e calcola le metriche di tutte le repliche insieme come operazioni su array.
+
+      Prende in input:
+         - test_y (np.ndarray): valori veri variabile target
+         - predizioni (np.ndarray): valori predetti variabile target
+         - tipo ("binary", "multiclass"): metriche di performance_binary o di performance_multiclass
+         - n_bootstrap (int): numero di repliche
+         - livello (float): livello di confidenza degli intervalli
+         - seed (int) opzionale: seed del generatore casuale
+         - dimensione_blocco (int) opzionale: repliche estratte per volta, di default ricavata da memoria_blocco
+         - memoria_blocco (int): byte massimi per le matrici di confusione di un blocco (n_blocco x k x k int64),
+                                 limita la memoria con molte classi. Le repliche delle metriche restano comunque
+                                 in memoria: 5 float64 per replica con "binary", 5 x k con "multiclass",
+                                 quindi la memoria cresce con n_bootstrap x k
+         - labels_float (dict) opzionale: nomi delle classi
+
+      Output:
+         - df_report, df_report_cm: come performance_binary / performance_multiclass
+         - df_report_cm_ci (pd.DataFrame): estremi degli intervalli per le metriche di df_report_cm
+                                           (per "multiclass" index (estremo, classe))
+   """
+   if tipo not in ["binary", "multiclass"]:
+      raise ValueError('tipo deve essere "binary" o "multiclass"')
+
+   if not isinstance(n_bootstrap,int) or n_bootstrap < 1:
+      raise ValueError("n_bootstrap deve essere un intero positivo")
+
+   if not isinstance(livello,float) or not 0 < livello < 1:
+      raise ValueError("livello deve essere un float tra 0 e 1")
+
+   if dimensione_blocco is not None and (not isinstance(dimensione_blocco,int) or dimensione_blocco < 1):
+      raise ValueError("dimensione_blocco deve essere un intero positivo")
+
+   if not isinstance(memoria_blocco,int) or memoria_blocco < 1:
+      raise ValueError("memoria_blocco deve essere un intero positivo")
+
+   labels, cm = _matrice_confusione(test_y, predizioni)
+   if tipo == "binary":
+      output = _performance_binary_da_matrice(labels, cm, labels_float=labels_float)
+   else:
+      output = _performance_multiclass_da_matrice(labels, cm, labels_float)
+
+   # Estrazioni multinomiali delle celle della matrice di confusione, a blocchi di repliche
+   rng = np.random.default_rng(seed)
+   k = len(labels)
+   totale = int(cm.sum())
+   probabilita = cm.ravel() / totale
+   if dimensione_blocco is None:
+      dimensione_blocco = max(1, memoria_blocco // (8 * k * k))
+
+   # Solo le metriche usate dagli intervalli, preallocate e riempite blocco per blocco:
+   # con "binary" quelle della classe positiva (n_bootstrap), con "multiclass" quelle per classe (n_bootstrap x k)
+   if tipo == "binary":
+      positiva = int(np.flatnonzero(labels == 1)[0])
+      colonne = ["Accuracy", "Precision", "Recall", "Specificity", "F1-Score"]
+      repliche = {nome: np.empty(n_bootstrap) for nome in colonne}
+   else:
+      colonne = ["recall", "specificity", "precision", "F1Score", "accuracy"]
+      repliche = {nome: np.empty((n_bootstrap, k)) for nome in colonne}
+
+   for inizio in range(0, n_bootstrap, dimensione_blocco):
+      n_blocco = min(dimensione_blocco, n_bootstrap - inizio)
+      cm_repliche = rng.multinomial(totale, probabilita, size=n_blocco).reshape(n_blocco, k, k)
+      # copia della diagonale: una vista terrebbe in memoria l'intero blocco cm_repliche
+      metriche = _metriche_per_classe(np.diagonal(cm_repliche, axis1=1, axis2=2).copy(),
+                                      cm_repliche.sum(axis=2), cm_repliche.sum(axis=1), totale)
+      del cm_repliche # liberare il blocco prima di estrarre il successivo
+
+      if tipo == "binary":
+         tp = metriche["TP"][:, positiva]
+         metriche = {'Accuracy': _dividi(metriche["TP"].sum(axis=1), totale),
+                     'Precision': metriche["precision"][:, positiva],
+                     'Recall': metriche["recall"][:, positiva],
+                     'Specificity': metriche["specificity"][:, positiva],
+                     'F1-Score': _dividi(2 * tp, 2 * tp + metriche["FP"][:, positiva] + metriche["FN"][:, positiva])}
+      for nome in colonne:
+         repliche[nome][inizio:inizio + n_blocco] = metriche[nome]
+
+   alpha = (1 - livello) / 2
+   nomi_estremi = [f"CI {100 * alpha:g}%", f"CI {100 * (1 - alpha):g}%"]
+
+   # overwrite_input: i quantili si calcolano riordinando le repliche sul posto, senza copie
+   estremi = {nome: np.quantile(repliche.pop(nome), [alpha, 1 - alpha], axis=0, overwrite_input=True)
+              for nome in colonne}
+   if tipo == "binary":
+      df_report_cm_ci = pd.DataFrame(estremi, index=nomi_estremi)
+   else:
+      df_report_cm_ci = pd.concat({nome_estremo: pd.DataFrame({nome: estremi[nome][i] for nome in colonne},
+                                                              index=output["df_report_cm"].index)
+                                   for i, nome_estremo in enumerate(nomi_estremi)})
+
+   output["df_report_cm_ci"] = df_report_cm_ci
+   return output
+
+
+def performance_soglie(test_y : np.ndarray,
+                       score : np.ndarray,
+                       metrica : Literal["Accuracy", "Precision", "Recall", "Specificity", "F1-Score"] = "F1-Score",
+                       verbose : bool = False
+                      ) -> dict:
+   """Funzione per scegliere la soglia di un classificatore binario a partire dagli score (es. predict_proba[:, 1]).
+      Ordina gli score una sola volta e con somme cumulate calcola la matrice di confusione per ogni soglia
+      distinta (predizione 1 se score >= soglia), quindi tutte le metriche in O(n log n) invece di
+      chiamare performance_binary per ogni soglia. Le colonne Recall e FPR danno la curva ROC,
+      Recall e Precision la curva precision-recall.
+
+      Prende in input:
+         - test_y (np.ndarray): valori veri variabile target, classe positiva codificata 1
+         - score (np.ndarray): score del modello, più alto = più probabile la classe 1
+         - metrica: metrica da massimizzare per scegliere la soglia migliore
+         - verbose (bool) opzionale: avere dei print o no
+
+      Output:
+         - df_soglie (pd.DataFrame): per ogni soglia TP, FP, FN, TN e le metriche di df_report_cm, più FPR
+         - soglia_migliore (float): soglia che massimizza metrica (la più alta in caso di parità)
+         - df_report_cm (pd.DataFrame): metriche alla soglia migliore, nello stesso formato di performance_binary
+   """
+   colonne = ["Accuracy", "Precision", "Recall", "Specificity", "F1-Score"]
+   if metrica not in colonne:
+      raise ValueError(f"metrica deve essere una tra {colonne}")
+
+   if not isinstance(verbose,bool):
+      raise TypeError("verbose deve essere un booleano")
+
+   positivi = np.ravel(test_y) == 1
+   score = np.ravel(score)
+   if len(positivi) != len(score):
+      raise ValueError("test_y e score devono avere la stessa lunghezza")
+
+   # Ordinare per score decrescente, l'ultima posizione di ogni score distinto è una soglia
+   ordine = np.argsort(score, kind="stable")[::-1]
+   score_ordinati = score[ordine]
+   positivi_ordinati = positivi[ordine]
+   ultimi = np.r_[np.flatnonzero(np.diff(score_ordinati)), len(score_ordinati) - 1]
+
+   tp = np.cumsum(positivi_ordinati)[ultimi]
+   fp = (ultimi + 1) - tp
+   fn = positivi.sum() - tp
+   tn = (~positivi).sum() - fp
+   totale = len(score)
+
+   recall = _dividi(tp, tp + fn)
+   precision = _dividi(tp, tp + fp)
+   df_soglie = pd.DataFrame({"soglia": score_ordinati[ultimi],
+                             "TP": tp, "FP": fp, "FN": fn, "TN": tn,
+                             "Accuracy": (tp + tn) / totale,
+                             "Precision": precision,
+                             "Recall": recall,
+                             "Specificity": _dividi(tn, tn + fp),
+                             "F1-Score": _dividi(2 * tp, 2 * tp + fp + fn),
+                             "FPR": _dividi(fp, fp + tn)})
+
+   migliore = int(np.argmax(df_soglie[metrica].to_numpy()))
+   soglia_migliore = float(df_soglie["soglia"].iloc[migliore])
+   df_report_cm = df_soglie.loc[[migliore], colonne].reset_index(drop=True)
+   df_report_cm.rename(index={0: "metrics (class 1)"}, inplace=True)
+
+   # region Verbose
+   if verbose:
+      print(f"Soglia migliore per {metrica}: {soglia_migliore}")
+      display(df_report_cm)
+   # endregion
+
+   output = {"df_soglie":df_soglie,
+             "soglia_migliore":soglia_migliore,
+             "df_report_cm":df_report_cm}
+   return output
+
+
+def performance_modelli(test_y : np.ndarray,
+                        predizioni : np.ndarray,
+                        tipo : Literal["binary", "multiclass"] = "binary",
+                        nomi_modelli : list = None,
+                        labels_float : dict = {}
+                       ) -> dict:
+   """Funzione per confrontare più modelli sugli stessi valori veri con una sola chiamata.
+      predizioni è una matrice (modelli x campioni), una riga per modello: i valori vengono codificati
+      una sola volta e tutte le matrici di confusione si ottengono con un unico np.bincount sui codici
+      modello * k * k + vero * k + predetto; le metriche sono calcolate per tutti i modelli insieme.
+
+      Prende in input:
+         - test_y (np.ndarray): valori veri variabile target
+         - predizioni (np.ndarray): valori predetti, una riga per modello
+         - tipo ("binary", "multiclass"): metriche come in performance_binary o performance_multiclass
+         - nomi_modelli (list) opzionale: nomi dei modelli, di default 0, 1, 2, ...
+         - labels_float (dict) opzionale: nomi delle classi (solo "multiclass")
+
+      Output:
+         - df_report_cm (pd.DataFrame): con "binary" le metriche della classe positiva per modello,
+                                        con "multiclass" le metriche per (modello, classe), per ogni modello
+                                        solo le classi presenti in test_y o nelle sue predizioni, numerate
+                                        e nominate come in performance_multiclass sul singolo modello
+         - df_riassunto (pd.DataFrame): per modello accuracy e medie macro / weighted di precision, recall
+                                        e f1-score (come in df_report), utile per ordinare i modelli
+   """
+   if tipo not in ["binary", "multiclass"]:
+      raise ValueError('tipo deve essere "binary" o "multiclass"')
+
+   test_y = np.ravel(test_y)
+   predizioni = np.asarray(predizioni)
+   if predizioni.ndim == 1:
+      predizioni = predizioni[None, :]
+   if predizioni.ndim != 2 or predizioni.shape[1] != len(test_y):
+      raise ValueError("predizioni deve essere una matrice (modelli x campioni) con tante colonne quanti valori in test_y")
+
+   n_modelli, n = predizioni.shape
+   if nomi_modelli is None:
+      nomi_modelli = list(range(n_modelli))
+   if len(nomi_modelli) != n_modelli:
+      raise ValueError("nomi_modelli deve avere un nome per ogni riga di predizioni")
+
+   # Un'unica codifica ed un unico bincount per tutte le matrici di confusione
+   labels, codici = np.unique(np.concatenate([test_y, predizioni.ravel()]), return_inverse=True)
+   k = len(labels)
+   codici = codici.ravel().astype(np.int64)
+   veri = codici[:n]
+   predetti_codici = codici[n:].reshape(n_modelli, n)
+   offset = np.arange(n_modelli, dtype=np.int64)[:, None] * (k * k)
+   cm = np.bincount((offset + veri[None, :] * k + predetti_codici).ravel(),
+                    minlength=n_modelli * k * k).reshape(n_modelli, k, k)
+
+   tp = np.diagonal(cm, axis1=1, axis2=2)
+   supporto = cm.sum(axis=2)
+   predetti = cm.sum(axis=1)
+   metriche = _metriche_per_classe(tp, supporto, predetti, n)
+
+   # Riassunto per modello, con le definizioni di classification_report: come chiamando la funzione
+   # sul singolo modello, le medie macro considerano solo le classi presenti in test_y o nelle sue predizioni
+   # (una classe predetta da un solo modello non abbassa le medie degli altri)
+   presenti = (supporto + predetti) > 0
+   n_presenti = presenti.sum(axis=1)
+   precision, recall = _dividi(tp, predetti), _dividi(tp, supporto)
+   f1 = _dividi(2 * tp, supporto + predetti)
+   df_riassunto = pd.DataFrame({"accuracy": tp.sum(axis=1) / n,
+                                "precision (macro avg)": (precision * presenti).sum(axis=1) / n_presenti,
+                                "recall (macro avg)": (recall * presenti).sum(axis=1) / n_presenti,
+                                "f1-score (macro avg)": (f1 * presenti).sum(axis=1) / n_presenti,
+                                "precision (weighted avg)": np.average(precision, axis=1, weights=supporto[0]),
+                                "recall (weighted avg)": np.average(recall, axis=1, weights=supporto[0]),
+                                "f1-score (weighted avg)": np.average(f1, axis=1, weights=supporto[0])},
+                               index=pd.Index(nomi_modelli, name="modello"))
+
+   if tipo == "binary":
+      positiva = _indice_positiva(labels)
+      TN, FP = cm[:, 0, 0], cm[:, 0, 1]
+      with np.errstate(divide="ignore", invalid="ignore"):
+         specificity = TN / (TN + FP)
+      df_report_cm = pd.DataFrame({"Accuracy": tp.sum(axis=1) / n,
+                                   "Precision": precision[:, positiva],
+                                   "Recall": recall[:, positiva],
+                                   "Specificity": specificity,
+                                   "F1-Score": f1[:, positiva]},
+                                  index=pd.Index(nomi_modelli, name="modello"))
+   else:
+      # Per ogni modello solo le sue classi, numerate come in performance_multiclass sul singolo modello:
+      # posizione della classe tra quelle presenti in test_y o nelle predizioni del modello
+      modelli_righe, classi_righe = np.nonzero(presenti)
+      posizioni = np.cumsum(presenti, axis=1) - 1
+      classi = [float(i) for i in posizioni[modelli_righe, classi_righe]]
+      if len(labels_float) > 0:
+         classi = [labels_float.get(str(i), str(i)) for i in classi]
+      index = pd.MultiIndex.from_arrays([[nomi_modelli[i] for i in modelli_righe], classi], names=["modello", "classe"])
+      df_report_cm = pd.DataFrame({nome: metriche[nome][presenti]
+                                   for nome in ["recall", "specificity", "precision", "F1Score", "accuracy"]},
+                                  index=index)
+
+   output = {"df_report_cm":df_report_cm,
+             "df_riassunto":df_riassunto}
+   return output
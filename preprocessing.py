@@ -1,19 +1,32 @@
 from typing import Union, List # Per specificare campi multipli nelll'input funzione
+import json # per salvare i vocabolari
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd 
 
 def feature_to_numeric(dataset:pd.DataFrame(),
                        feature_name: Union[str, List[str]],
-                       verbose : bool = False
+                       verbose : bool = False,
+                       n_jobs : int = 1
                      ) -> dict : 
 
    """ Funzione per ricodificare le classi da stringhe a numeri. Molto utile per il preprocessing prima delle classificazioni
    Invece di utilizzare "from sklearn.preprocessing import LabelEncoder", utilizzo direttamente una funzione pandas.
    # basata su:  astype('category') / cat.codes / cat.categories
 
+   Per ridurre il picco di memoria ogni variabile viene scritta nel dataset una sola volta, direttamente
+   con i codici nel più piccolo dtype intero (int8/int16/int32) senza passare da una colonna "category";
+   con n_jobs > 1 le variabili vengono codificate in parallelo su più thread.
+   Le colonne con dati Arrow (pd.ArrowDtype, "string[pyarrow]", "str" di pandas 3) vengono già codificate da pandas
+   con dictionary_encode di pyarrow, senza conversione; le colonne object conviene lasciarle a pandas perché la
+   conversione in Arrow costerebbe più della codifica.
+
    Prende in input:
       - dataset (pd.DataFrame): dataset nel quale c'è la variabile da ricodificare
       - feature_name (str o lista di str): variabile/i da ricodificare
       - verbose (bool) :  se mostrare i risultati
+      - n_jobs (int) : numero di thread con cui codificare le variabili
 
    Output:
       - dataset (pd.DataFrame): con variabile ricodificata
@@ -27,6 +40,9 @@ def feature_to_numeric(dataset:pd.DataFrame(),
    if not isinstance(verbose,bool):
       raise TypeError("verbose deve essere un booleano")
 
+   if not isinstance(n_jobs,int) or n_jobs < 1:
+      raise ValueError("n_jobs deve essere un intero positivo")
+
    # Per il controllo delle variabili in input ci sono dei passaggi aggiuntivi data la doppia natura
    ## Se è una stringa inserirla dentro una lista
    if isinstance(feature_name, str):
@@ -41,23 +57,28 @@ def feature_to_numeric(dataset:pd.DataFrame(),
    # endregion
 
    # region Main
+   # Codificare le variabili (in parallelo se n_jobs > 1): pd.Categorical restituisce codici e categorie
+   # senza scrivere una colonna "category" nel dataset, i codici sono già nel più piccolo dtype intero
+   if n_jobs > 1 and len(feature_name) > 1:
+      with ThreadPoolExecutor(max_workers=min(n_jobs, len(feature_name))) as executor:
+         categoriche = list(executor.map(lambda feature: pd.Categorical(dataset[feature]), feature_name))
+   else:
+      categoriche = [pd.Categorical(dataset[feature]) for feature in feature_name]
+
    labels_list = {} # inizializzare due dizionari per salvare le labels
    labels_float_list = {}
-   for feature in feature_name:
-      # Convertire variabile originale in formato "category", operazione necessaria per poi ricodificare
-      dataset[f'{feature}'] = dataset[f'{feature}'].astype('category')
-
+   for feature, categorica in zip(feature_name, categoriche):
       # Creazione del dizionario delle labels
-      labels = dict(enumerate(dataset[f'{feature}'].cat.categories))
+      labels = dict(enumerate(categorica.categories))
       labels_list[feature]=labels # Salvare queste labels
 
       # Le classi nella valutazione della performance vengono codificate in float, trasformarle subito il float per avere una corrispondenza
       labels_float = {str(float(label)):labels[label]  for  label in labels.keys()} 
       labels_float_list[feature] = labels_float # Salvare queste labels
 
-      # Creare nuoba variabile ricodificata i numeri, la precedente viene mantenuta per ottenere mappatura labels
-      dataset[f'{feature}'] = dataset[f'{feature}'].cat.codes
-      # endregion
+      # Sostituire la variabile con i codici, un'unica scrittura della colonna
+      dataset[feature] = categorica.codes
+   # endregion
 
    # region Verbose
    if verbose:
@@ -72,4 +93,273 @@ def feature_to_numeric(dataset:pd.DataFrame(),
              "labels":labels_list,
              "labels_float": labels_float_list
             }
-   return output
\ No newline at end of file
+   return output
+
+def _dtype_codici(n_categorie : int):
+   """Il più piccolo dtype intero per i codici di n_categorie categorie (come i codici di pandas Categorical)."""
+   for dtype in [np.int8, np.int16, np.int32]:
+      if n_categorie < np.iinfo(dtype).max:
+         return dtype
+   return np.int64
+
+class CodificatoreCategorie:
+   """Codificatore riutilizzabile per ricodificare le classi da stringhe a numeri come feature_to_numeric.
+      Le categorie (vocabolario) di ogni variabile vengono apprese una sola volta con fit, poi transform
+      codifica nuovi dati con una tabella hash precalcolata (pd.Index.get_indexer), senza ricalcolare le categorie:
+      batch codificati separatamente hanno sempre gli stessi codici. I valori mai visti (e i NaN) ricevono codice_sconosciuto,
+      che non può coincidere con il codice di una categoria (negativo oppure almeno pari al numero di categorie).
+
+      Esempio:
+         codificatore = CodificatoreCategorie().fit(train, ["colore", "forma"])
+         codificatore.salva("vocabolari.json")
+         ...
+         codificatore = CodificatoreCategorie.carica("vocabolari.json")
+         richiesta = codificatore.transform(richiesta)
+   """
+
+   def __init__(self, codice_sconosciuto : int = -1):
+      if not isinstance(codice_sconosciuto,int):
+         raise TypeError("codice_sconosciuto deve essere un intero")
+
+      self.codice_sconosciuto = codice_sconosciuto
+      self.categorie = {} # variabile -> pd.Index delle categorie
+
+   def _controlla_feature(self, dataset : pd.DataFrame, feature_name) -> list:
+      if not isinstance(dataset,pd.DataFrame):
+         raise TypeError("dataset deve essere un pandas dataframe")
+
+      if isinstance(feature_name, str):
+         feature_name = [feature_name]
+
+      for feature in feature_name:
+         if not isinstance(feature,str):
+            raise TypeError("Specificare le variabili sotto forma di stringa")
+
+         if feature not in dataset.columns:
+            raise ValueError(f"Variabile {feature} non è presente nel dataset")
+      return list(feature_name)
+
+   def fit(self,
+           dataset : pd.DataFrame,
+           feature_name: Union[str, List[str]]):
+      """Apprende le categorie delle variabili, nello stesso ordine di astype('category')."""
+      for feature in self._controlla_feature(dataset, feature_name):
+         self.categorie[feature] = pd.Index(dataset[feature].astype('category').cat.categories)
+      return self
+
+   def aggiorna(self,
+                dataset : pd.DataFrame,
+                feature_name: Union[str, List[str]]):
+      """Aggiunge ai vocabolari le categorie di un nuovo blocco di dati (fit incrementale).
+         L'unione resta ordinata, quindi dopo aver visto tutti i blocchi le categorie sono le stesse di fit sull'intero dataset."""
+      for feature in self._controlla_feature(dataset, feature_name):
+         nuove = pd.Index(dataset[feature].astype('category').cat.categories)
+         if feature in self.categorie:
+            nuove = self.categorie[feature].union(nuove)
+         self.categorie[feature] = nuove
+      return self
+
+   def transform(self,
+                 dataset : pd.DataFrame,
+                 inplace : bool = False) -> pd.DataFrame:
+      """Codifica le variabili apprese con fit. Con inplace=False il dataset in input non viene modificato."""
+      if not isinstance(inplace,bool):
+         raise TypeError("inplace deve essere un booleano")
+
+      if len(self.categorie) == 0:
+         raise ValueError("Il codificatore non ha vocabolari, chiamare prima fit o carica")
+
+      self._controlla_feature(dataset, list(self.categorie))
+      for feature, categorie in self.categorie.items():
+         # Un codice_sconosciuto tra 0 e len(categorie) - 1 confonderebbe i valori mai visti con una categoria vera
+         if 0 <= self.codice_sconosciuto < len(categorie):
+            raise ValueError(f"codice_sconosciuto ({self.codice_sconosciuto}) coincide con il codice di una categoria "
+                             f"di {feature}, usare un valore negativo o almeno {len(categorie)}")
+      if not inplace:
+         dataset = dataset.copy()
+
+      for feature, categorie in self.categorie.items():
+         codici = categorie.get_indexer(dataset[feature])
+         dtype = _dtype_codici(max(len(categorie), abs(self.codice_sconosciuto) + 1))
+         if self.codice_sconosciuto != -1:
+            codici[codici == -1] = self.codice_sconosciuto
+         dataset[feature] = codici.astype(dtype)
+      return dataset
+
+   def fit_transform(self,
+                     dataset : pd.DataFrame,
+                     feature_name: Union[str, List[str]],
+                     inplace : bool = False) -> pd.DataFrame:
+      return self.fit(dataset, feature_name).transform(dataset, inplace=inplace)
+
+   @property
+   def labels(self) -> dict:
+      """Mappa numeri / classi per ogni variabile, come labels di feature_to_numeric."""
+      return {feature: dict(enumerate(categorie)) for feature, categorie in self.categorie.items()}
+
+   @property
+   def labels_float(self) -> dict:
+      """Mappa numeri (come stringhe di float) / classi per ogni variabile, come labels_float di feature_to_numeric."""
+      return {feature: {str(float(codice)): classe for codice, classe in labels.items()}
+              for feature, labels in self.labels.items()}
+
+   def salva(self, path_file : str):
+      """Salva i vocabolari in un file JSON (le categorie devono essere serializzabili in JSON)."""
+      contenuto = {"codice_sconosciuto": self.codice_sconosciuto,
+                   "categorie": {feature: categorie.tolist() for feature, categorie in self.categorie.items()}}
+      with open(path_file, "w", encoding="utf-8") as file:
+         json.dump(contenuto, file, ensure_ascii=False)
+
+   @classmethod
+   def carica(cls, path_file : str):
+      """Carica un codificatore salvato con salva."""
+      with open(path_file, encoding="utf-8") as file:
+         contenuto = json.load(file)
+      codificatore = cls(codice_sconosciuto=contenuto["codice_sconosciuto"])
+      codificatore.categorie = {feature: pd.Index(categorie) for feature, categorie in contenuto["categorie"].items()}
+      return codificatore
+
+
+def _formato_file(path_file : str) -> str:
+   estensione = os.path.splitext(path_file)[1].lower()
+   if estensione not in [".csv", ".parquet"]:
+      raise ValueError(f"Formato di {path_file} non supportato, usare .csv o .parquet")
+   return estensione[1:]
+
+def _unisci_dtype(dtype_a, dtype_b):
+   """dtype di una colonna che in due blocchi ha dtype_a e dtype_b: interi e float diventano float,
+      ogni altra combinazione diversa diventa object (stringhe), come leggendo il file intero."""
+   if dtype_a == dtype_b:
+      return dtype_a
+   numerici = all(pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype)
+                  for dtype in [dtype_a, dtype_b])
+   return np.result_type(dtype_a, dtype_b) if numerici else np.dtype(object)
+
+def _dtype_csv(path_file : str, chunksize : int, **kwargs_lettura) -> dict:
+   """read_csv inferisce i dtype blocco per blocco (ad esempio interi in un blocco e stringhe in un altro):
+      legge il CSV a blocchi e unisce i dtype di ogni colonna in uno valido per l'intero file, da passare come dtype=."""
+   dtypes = {}
+   for blocco in pd.read_csv(path_file, chunksize=chunksize, **kwargs_lettura):
+      for colonna, dtype in blocco.dtypes.items():
+         dtypes[colonna] = _unisci_dtype(dtypes.get(colonna, dtype), dtype)
+   return {colonna: str if dtype == object else dtype for colonna, dtype in dtypes.items()}
+
+def _leggi_a_blocchi(path_file : str, chunksize : int, colonne : list = None, **kwargs_lettura):
+   """Genera il file a blocchi di chunksize righe come pandas dataframe (CSV con pandas, Parquet con pyarrow)."""
+   if _formato_file(path_file) == "csv":
+      yield from pd.read_csv(path_file, chunksize=chunksize, usecols=colonne, **kwargs_lettura)
+      return
+
+   try:
+      import pyarrow.parquet as pq
+   except ImportError:
+      raise ImportError("Per leggere file Parquet serve pyarrow: pip install pyarrow")
+   for batch in pq.ParquetFile(path_file).iter_batches(batch_size=chunksize, columns=colonne):
+      yield batch.to_pandas()
+
+def _schema_parquet(blocco : pd.DataFrame, schema_input):
+   """Schema pyarrow del file di output, fissato sul primo blocco codificato: le colonne object sono stringhe
+      (un blocco con soli valori mancanti darebbe il tipo null) e le colonne non codificate di un file Parquet
+      mantengono il tipo del file di input."""
+   import pyarrow as pa
+   campi = []
+   for campo in pa.Schema.from_pandas(blocco, preserve_index=False):
+      if pd.api.types.is_integer_dtype(blocco[campo.name].dtype):
+         pass # codici e colonne intere hanno già il tipo del blocco
+      elif schema_input is not None and campo.name in schema_input.names:
+         campo = schema_input.field(campo.name)
+      elif blocco[campo.name].dtype == object:
+         campo = pa.field(campo.name, pa.string())
+      campi.append(campo)
+   return pa.schema(campi)
+
+def feature_to_numeric_file(path_input : str,
+                            path_output : str,
+                            feature_name: Union[str, List[str]],
+                            chunksize : int = 1_000_000,
+                            verbose : bool = False,
+                            **kwargs_lettura
+                           ) -> dict:
+   """ Versione di feature_to_numeric per file CSV/Parquet più grandi della memoria.
+   Il file viene letto a blocchi di chunksize righe:
+      0. solo per i CSV, tutte le colonne per fissare i dtype sull'intero file (vedi _dtype_csv), così ogni blocco
+         viene poi letto con gli stessi dtype invece di quelli inferiti sul singolo blocco
+      1. solo le variabili da ricodificare, per costruire incrementalmente i vocabolari (CodificatoreCategorie.aggiorna)
+      2. tutte le colonne, ricodificate blocco per blocco e scritte in path_output (CSV o Parquet secondo l'estensione)
+   Le categorie, e quindi labels / labels_float, sono le stesse di feature_to_numeric sull'intero dataset
+   letto con pd.read_csv(path_input, low_memory=False) o pd.read_parquet(path_input).
+
+   Prende in input:
+      - path_input (str): file .csv o .parquet da ricodificare
+      - path_output (str): file .csv o .parquet in cui scrivere il dataset ricodificato
+      - feature_name (str o lista di str): variabile/i da ricodificare
+      - chunksize (int): righe per blocco
+      - verbose (bool) :  se mostrare i risultati
+      - kwargs_lettura: argomenti aggiuntivi per pd.read_csv (es. dtype, sep), solo con file CSV
+
+   Output:
+      - path_output (str): file scritto
+      - labels (dict) : mappa con corrispondenza numeri / classi
+      - labels_float (dict) : mappa con corrispondenza numeri / classi modificata per compatibilità con i risultati delle performance metrics 
+      - codificatore (CodificatoreCategorie): per codificare nuovi dati con gli stessi codici
+   """
+   if not isinstance(verbose,bool):
+      raise TypeError("verbose deve essere un booleano")
+
+   if not isinstance(chunksize,int) or chunksize < 1:
+      raise ValueError("chunksize deve essere un intero positivo")
+
+   if isinstance(feature_name, str):
+      feature_name = [feature_name]
+
+   formato_input = _formato_file(path_input)
+   formato_output = _formato_file(path_output)
+
+   schema_input = None
+   if formato_input == "csv":
+      # Passaggio 0: dtype validi per l'intero file
+      kwargs_lettura = {**kwargs_lettura, "dtype": _dtype_csv(path_input, chunksize, **kwargs_lettura)}
+   elif len(kwargs_lettura) > 0:
+      raise ValueError(f"Argomenti di lettura {list(kwargs_lettura)} non supportati per file Parquet")
+   else:
+      import pyarrow.parquet as pq
+      schema_input = pq.ParquetFile(path_input).schema_arrow
+
+   # Primo passaggio: vocabolari
+   codificatore = CodificatoreCategorie()
+   for blocco in _leggi_a_blocchi(path_input, chunksize, colonne=feature_name, **kwargs_lettura):
+      codificatore.aggiorna(blocco, feature_name)
+
+   # Secondo passaggio: codifica e scrittura blocco per blocco
+   writer = None
+   schema = None
+   primo_blocco = True
+   try:
+      for blocco in _leggi_a_blocchi(path_input, chunksize, **kwargs_lettura):
+         blocco = codificatore.transform(blocco, inplace=True)
+         if formato_output == "csv":
+            blocco.to_csv(path_output, mode="w" if primo_blocco else "a", header=primo_blocco, index=False)
+         else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            if writer is None:
+               schema = _schema_parquet(blocco, schema_input)
+               writer = pq.ParquetWriter(path_output, schema)
+            writer.write_table(pa.Table.from_pandas(blocco, schema=schema, preserve_index=False))
+         primo_blocco = False
+   finally:
+      if writer is not None:
+         writer.close()
+
+   # region Verbose
+   if verbose:
+      # Printare labels
+      print(f"labels: {codificatore.labels}")
+   # endregion
+
+   output = {"path_output":path_output,
+             "labels":codificatore.labels,
+             "labels_float":codificatore.labels_float,
+             "codificatore":codificatore
+            }
+   return output
@@ -4,14 +4,165 @@ import os
 import numpy as np
 from PIL import Image
 import hashlib # per gli hash
+import threading
+import sqlite3 # per l'indice persistente dei fingerprint
+from collections import OrderedDict, deque # per la cache LRU e le code di lavoro
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+def _decodifica(path_image : str, dimensione : Union[tuple, None] = None) -> tuple:
+   """Decodifica un'immagine e restituisce (mode, array).
+      Se dimensione (larghezza, altezza) è indicata l'immagine viene decodificata direttamente a risoluzione
+      ridotta: per i JPEG con draft (IDCT ridotta nel dominio DCT), poi con reduce sull'immagine intera
+      (media su blocchi di pixel) e infine in float32 con resize BOX (media pesata sull'area, senza arrotondamenti).
+      Non viene mai creata una copia float a piena risoluzione. L'errore introdotto è descritto in _tolleranza_ridotta."""
+   with Image.open(path_image) as image:
+      if dimensione is None:
+         return image.mode, np.array(image)
+
+      larghezza, altezza = dimensione
+      mode = image.mode
+      image.draft(mode, (larghezza, altezza))
+      if mode in ["P", "1"]:
+         image = image.convert("RGB" if mode == "P" else "L")
+      elif mode.startswith("I;16"):
+         image = image.convert("I")
+      fattore = min(image.width // larghezza, image.height // altezza)
+      if fattore >= 2:
+         image = image.reduce(fattore)
+      bande = [np.asarray(banda.convert("F").resize((larghezza, altezza), Image.Resampling.BOX))
+               for banda in image.split()]
+      return mode, bande[0] if len(bande) == 1 else np.stack(bande, axis=-1)
+
+def _tolleranza_ridotta(path_image : str, dimensione : tuple, tolleranza : float) -> float:
+   """Tolleranza da usare sull'immagine ridotta da _decodifica perché due immagini simili con tolleranza
+      a piena risoluzione restino simili anche ridotte (legge solo l'header del file):
+         - senza riduzione intera (immagine meno di 2 volte più grande di dimensione): tolleranza,
+           il resize BOX in float è una media pesata e non aumenta la differenza massima
+         - reduce senza draft: tolleranza + 1, reduce è una media su blocchi arrotondata a intero (+0.5 per immagine)
+         - JPEG con draft: 1.25 * tolleranza + 2. La IDCT ridotta di libjpeg si comporta come una media sui blocchi
+           (pesi misurati non negativi e a somma 1), ma la decodifica a piena risoluzione e quella ridotta arrotondano
+           e saturano in modo diverso, e il croma sottocampionato viene ricostruito diversamente: su 300 coppie
+           di JPEG sintetici (qualità 30-100, scale 1/2-1/8) la differenza ridotta non ha mai superato
+           quella a piena risoluzione + 2, il 25% in più sulla tolleranza è un margine su questa misura."""
+   with Image.open(path_image) as image:
+      fattore = min(image.width // dimensione[0], image.height // dimensione[1])
+      if fattore < 2:
+         return tolleranza
+      if image.format == "JPEG":
+         return 1.25 * tolleranza + 2
+      return tolleranza + 1
+
+class CacheImmagini:
+   """Cache LRU degli array NumPy delle immagini decodificate.
+      Le immagini sono indicizzate per path, mtime e dimensione del file: se il file cambia su disco
+      viene decodificato di nuovo. Quando i byte occupati superano max_bytes vengono eliminate
+      le immagini usate meno di recente.
+
+      Gli array restituiti sono in sola lettura, perché condivisi tra tutte le chiamate.
+
+      Attributi:
+         - hits / misses: contatori delle letture servite dalla cache o decodificate
+         - bytes_occupati: byte attualmente occupati dagli array in cache
+   """
+
+   def __init__(self, max_bytes : int = 512 * 1024**2):
+      if not isinstance(max_bytes,int) or max_bytes < 0:
+         raise TypeError("max_bytes deve essere un intero non negativo")
+
+      self.max_bytes = max_bytes
+      self.hits = 0
+      self.misses = 0
+      self.bytes_occupati = 0
+      self._immagini = OrderedDict()
+      self._lock = threading.Lock()
+
+   def __len__(self):
+      return len(self._immagini)
+
+   def _chiave(self, path_image : str, *extra) -> tuple:
+      stat = os.stat(path_image)
+      return (os.path.abspath(path_image), stat.st_mtime_ns, stat.st_size) + extra
+
+   def _leggi(self, chiave : tuple):
+      with self._lock:
+         if chiave in self._immagini:
+            self._immagini.move_to_end(chiave)
+            self.hits += 1
+            return self._immagini[chiave]
+         self.misses += 1
+         return None
+
+   def _salva(self, chiave : tuple, mode : str, image_array : np.ndarray):
+      image_array.flags.writeable = False
+      if image_array.nbytes > self.max_bytes:
+         return
+      with self._lock:
+         if chiave in self._immagini:
+            return
+         self._immagini[chiave] = (mode, image_array)
+         self.bytes_occupati += image_array.nbytes
+         # Eliminare le immagini usate meno di recente fino a rientrare nel budget
+         while self.bytes_occupati > self.max_bytes:
+            _, (_, vecchio_array) = self._immagini.popitem(last=False)
+            self.bytes_occupati -= vecchio_array.nbytes
+
+   def carica(self, path_image : str, dimensione : Union[tuple, None] = None) -> tuple:
+      """Restituisce (mode, array) dell'immagine, decodificandola solo se non è già in cache.
+         Con dimensione l'immagine è decodificata a risoluzione ridotta (vedi _decodifica)."""
+      chiave = self._chiave(path_image, dimensione)
+      valore = self._leggi(chiave)
+      if valore is not None:
+         return valore
+
+      mode, image_array = _decodifica(path_image, dimensione)
+      self._salva(chiave, mode, image_array)
+      return mode, image_array
+
+   def svuota(self):
+      """Svuota la cache e azzera i contatori."""
+      with self._lock:
+         self._immagini.clear()
+         self.bytes_occupati = 0
+         self.hits = 0
+         self.misses = 0
+
+# Cache condivisa usata di default da immagini_uguali e immagini_simili
+cache_immagini = CacheImmagini()
+
+def _carica_array(path_image : str,
+                  cache : Union[CacheImmagini, None],
+                  dimensione : Union[tuple, None] = None
+                 ) -> tuple:
+   """Restituisce (mode, array) dell'immagine, passando dalla cache se presente."""
+   if cache is not None:
+      return cache.carica(path_image, dimensione)
+   return _decodifica(path_image, dimensione)
+
+def _ridimensiona_array(path_image : str,
+                        mode : str,
+                        image_array : np.ndarray,
+                        size : tuple
+                       ) -> np.ndarray:
+   """Ridimensiona l'array di un'immagine a size (larghezza, altezza) come farebbe Image.resize.
+      Per le modalità che non si ricostruiscono esattamente da un array (ad esempio "P") l'immagine viene riaperta."""
+   if (image_array.shape[1], image_array.shape[0]) == tuple(size):
+      return image_array
+
+   if mode in ["L", "RGB", "RGBA"]:
+      return np.array(Image.fromarray(image_array).resize(size))
+
+   with Image.open(path_image) as image:
+      return np.array(image.resize(size))
 
 def immagini_uguali(path_image1 : str,
                     path_image2: str,
                     verbose : bool = False, 
+                    cache : Union[CacheImmagini, None] = cache_immagini,
                    ) -> bool:
    """
    Questa funzione controlla che due immagini siano uguali.
    Prende in input il path delle due immagini, le importa e tramite numpy controlla che siano uguali pixel by pixel.
+   Le immagini decodificate vengono prese da cache (di default la cache condivisa cache_immagini), None per non usarla.
 
    Output:
       Restituisce True se uguali False se diverse.
@@ -28,13 +179,9 @@ def immagini_uguali(path_image1 : str,
 
 
 
-   # Importare le immagini
-   image1 = Image.open(path_image1)
-   image2 = Image.open(path_image2)
-
-   # Converte le immagini in array NumPy
-   image1_array = np.array(image1)
-   image2_array = np.array(image2)
+   # Importare le immagini come array NumPy
+   _, image1_array = _carica_array(path_image1, cache)
+   _, image2_array = _carica_array(path_image2, cache)
 
    # Controlla se le due immagini sono uguali
    are_images_equal = np.array_equal(image1_array, image2_array)
@@ -55,11 +202,19 @@ def immagini_simili(path_image1 : str,
                     path_image2: str,
                     tolleranza : float =  1e-5,
                     verbose : bool = False, 
+                    cache : Union[CacheImmagini, None] = cache_immagini,
+                    dimensione_confronto : Union[tuple, None] = None,
                    ) -> bool:
    """
    Questa funzione controlla che due immagini siano uguali.
    Prende in input il path delle due immagini, le importa e tramite numpy controlla che siano uguali pixel by pixel.
+   Le immagini decodificate vengono prese da cache (di default la cache condivisa cache_immagini), None per non usarla.
 
+   Con dimensione_confronto (larghezza, altezza) entrambe le immagini vengono decodificate direttamente
+   a quella dimensione (draft per i JPEG, reduce per gli altri formati, vedi _decodifica) invece che a piena
+   risoluzione. Gli arrotondamenti della decodifica ridotta possono aumentare la differenza tra i pixel, quindi
+   la tolleranza viene scalata (vedi _tolleranza_ridotta, al più 1.25 * tolleranza + 2 per i JPEG): due immagini
+   simili a piena risoluzione lo restano ridotte (il contrario non vale, la riduzione può nascondere differenze locali).
 
    Output:
       Restituisce True se uguali False se diverse.
@@ -79,20 +234,21 @@ def immagini_simili(path_image1 : str,
 
    
 
-   # Importare le immagini
-   image1 = Image.open(path_image1)
-   image2 = Image.open(path_image2)
-
-   # Converte le immagini in array NumPy
-   image1_array = np.array(image1)
-   image2_array = np.array(image2)
-
-
-   # Ridimensiona l'immagine 2 alle dimensioni di image1
-   image2_resized = image2.resize(image1.size)
+   if dimensione_confronto is not None:
+      # Decodificare entrambe le immagini già alla dimensione di confronto
+      _, image1_array = _carica_array(path_image1, cache, tuple(dimensione_confronto))
+      _, image2_array = _carica_array(path_image2, cache, tuple(dimensione_confronto))
+      image2_resized_array = image2_array
+      tolleranza = max(_tolleranza_ridotta(path_image1, tuple(dimensione_confronto), tolleranza),
+                       _tolleranza_ridotta(path_image2, tuple(dimensione_confronto), tolleranza))
+   else:
+      # Importare le immagini come array NumPy
+      _, image1_array = _carica_array(path_image1, cache)
+      mode2, image2_array = _carica_array(path_image2, cache)
 
-   # Converte l'immagine ridimensionata in array NumPy
-   image2_resized_array = np.array(image2_resized)
+      # Ridimensiona l'immagine 2 alle dimensioni di image1
+      image2_resized_array = _ridimensiona_array(path_image2, mode2, image2_array,
+                                                 (image1_array.shape[1], image1_array.shape[0]))
 
    # Confronta le immagini con tolleranza
    are_images_equal = np.allclose(image1_array, image2_resized_array, atol=tolleranza)
@@ -109,17 +265,483 @@ def immagini_simili(path_image1 : str,
 
    return are_images_equal
 
+def _matrice_thumbnail(path_images : list, dimensione_thumbnail : tuple) -> tuple:
+   """Decodifica ogni immagine una volta, la riduce a thumbnail RGB e restituisce la matrice contigua
+      (n immagini x pixel) in float32 e gli indici delle immagini lette.
+      I file che non si aprono (cartelle, file non immagine) vengono segnalati e saltati."""
+   larghezza, altezza = dimensione_thumbnail
+   matrice = np.empty((len(path_images), altezza * larghezza * 3), dtype=np.float32)
+   validi = []
+   for i, path_image in enumerate(path_images):
+      try:
+         with Image.open(path_image) as image:
+            image.draft("RGB", (larghezza, altezza)) # per i JPEG decodifica già ridotta
+            thumbnail = image.convert("RGB").resize((larghezza, altezza))
+      except Exception as e:
+         print(f"Errore nell'aprire {path_image}: {e}")
+         continue
+      matrice[len(validi)] = np.asarray(thumbnail, dtype=np.float32).ravel()
+      validi.append(i)
+   return matrice[:len(validi)], validi
+
+def immagini_simili_batch(path_images : List[str],
+                          tolleranza : float = 1e-5,
+                          dimensione_thumbnail : tuple = (32, 32),
+                          dimensione_blocco : int = 64,
+                          metrica : Literal["max", "mean"] = "max",
+                         ) -> list:
+   """
+   Versione batch di immagini_simili: ogni immagine viene ridotta una sola volta ad una thumbnail
+   di dimensione_thumbnail (larghezza, altezza), le thumbnail vengono impilate in una matrice NumPy
+   e le differenze tra tutte le coppie si calcolano a blocchi di dimensione_blocco x dimensione_blocco
+   immagini con il broadcasting, invece di una chiamata a np.allclose per coppia.
+
+   Con metrica "max" due immagini sono simili con la stessa regola di np.allclose usata da immagini_simili
+   (|a - b| <= tolleranza + 1e-5 * |b| per ogni pixel), con "mean" se la differenza assoluta media
+   è al più tolleranza. Il confronto avviene sulle thumbnail e non a piena risoluzione.
+   I path che non si aprono come immagini vengono segnalati e saltati, come negli altri controlli.
+
+   Prende in input:
+      - path_images (lista di str): path delle immagini
+      - tolleranza (float): tolleranza sui valori dei pixel (0-255)
+      - dimensione_thumbnail (tuple): dimensione a cui ridurre le immagini
+      - dimensione_blocco (int): numero di immagini per blocco, determina la memoria usata
+      - metrica ("max", "mean"): differenza massima o media tra i pixel
+
+   Output:
+      Lista di coppie (path immagine i, path immagine j), i < j, di immagini simili.
+   """
+   if not isinstance(tolleranza,float):
+      raise TypeError("tolleranza deve essere un float")
+
+   if metrica not in ["max", "mean"]:
+      raise ValueError('metrica deve essere "max" o "mean"')
+
+   if not isinstance(dimensione_blocco,int) or dimensione_blocco < 1:
+      raise ValueError("dimensione_blocco deve essere un intero positivo")
+
+   matrice, validi = _matrice_thumbnail(path_images, dimensione_thumbnail)
+   path_images = [path_images[i] for i in validi]
+   n = len(matrice)
+   rtol = 1e-5 # rtol di default di np.allclose
+
+   coppie = []
+   for inizio_i in range(0, n, dimensione_blocco):
+      blocco_i = matrice[inizio_i:inizio_i + dimensione_blocco]
+      for inizio_j in range(inizio_i, n, dimensione_blocco):
+         blocco_j = matrice[inizio_j:inizio_j + dimensione_blocco]
+
+         differenze = np.abs(blocco_i[:, None, :] - blocco_j[None, :, :])
+         if metrica == "max":
+            differenze -= rtol * np.abs(blocco_j)[None, :, :]
+            simili = differenze.max(axis=2) <= tolleranza
+         else:
+            simili = differenze.mean(axis=2) <= tolleranza
+
+         for a, b in zip(*np.nonzero(simili)):
+            i, j = inizio_i + int(a), inizio_j + int(b)
+            if i < j:
+               coppie.append((i, j))
+
+   coppie.sort()
+   return [(path_images[i], path_images[j]) for i, j in coppie]
+
+def digest_immagine(path_image : str) -> bytes:
+   """
+   Calcola un digest del contenuto di un'immagine.
+   L'immagine viene decodificata una sola volta e il digest comprende, oltre ai pixel,
+   anche la modalità (RGB, L, ...), la shape ed il dtype dell'array, così due immagini
+   hanno lo stesso digest solo se sono uguali pixel by pixel.
+
+   Output:
+      Restituisce il digest (bytes) dell'immagine.
+   """
+   if not isinstance(path_image,str):
+      raise TypeError("path_image deve essere una stringa")
+
+   with Image.open(path_image) as image:
+      mode = image.mode
+      image_array = np.array(image)
+
+   h = hashlib.blake2b(digest_size=16)
+   h.update(f"{mode}|{image_array.shape}|{image_array.dtype.str}|".encode())
+   h.update(np.ascontiguousarray(image_array).data)
+   return h.digest()
+
+def _matrice_dct(n : int) -> np.ndarray:
+   """Matrice della DCT-II ortonormale di dimensione n x n."""
+   k = np.arange(n)[:, None]
+   x = np.arange(n)[None, :]
+   matrice = np.cos(np.pi * (2 * x + 1) * k / (2 * n)) * np.sqrt(2 / n)
+   matrice[0, :] = np.sqrt(1 / n)
+   return matrice
+
+def hash_percettivo(path_image : str,
+                    tipo_hash : Literal["average", "difference", "dct"] = "difference",
+                    dimensione_hash : int = 8
+                   ) -> int:
+   """
+   Calcola l'hash percettivo di un'immagine, un intero di dimensione_hash**2 bit (64 di default).
+   Immagini quasi uguali (ricodificate, leggermente ritagliate o ridimensionate) hanno hash
+   che differiscono di pochi bit, la distanza si misura con distanza_hamming.
+
+   Prende in input:
+      - path_image (str): path dell'immagine
+      - tipo_hash: "average" (pixel sopra la media), "difference" (gradiente orizzontale),
+                   "dct" (basse frequenze della DCT sopra la mediana)
+      - dimensione_hash (int): lato della griglia di bit
+
+   Output:
+      - hash (int)
+   """
+   if not isinstance(path_image,str):
+      raise TypeError("path_image deve essere una stringa")
+
+   if tipo_hash not in ["average", "difference", "dct"]:
+      raise ValueError('tipo_hash deve essere "average", "difference" o "dct"')
+
+   n = dimensione_hash
+   with Image.open(path_image) as image:
+      image = image.convert("L")
+      if tipo_hash == "average":
+         pixel = np.asarray(image.resize((n, n), Image.LANCZOS), dtype=np.float64)
+         bits = pixel > pixel.mean()
+      elif tipo_hash == "difference":
+         pixel = np.asarray(image.resize((n + 1, n), Image.LANCZOS), dtype=np.float64)
+         bits = pixel[:, 1:] > pixel[:, :-1]
+      else:
+         lato = 4 * n
+         pixel = np.asarray(image.resize((lato, lato), Image.LANCZOS), dtype=np.float64)
+         dct = _matrice_dct(lato)
+         basse_frequenze = (dct @ pixel @ dct.T)[:n, :n]
+         bits = basse_frequenze > np.median(basse_frequenze)
+
+   return int.from_bytes(np.packbits(bits.ravel()).tobytes(), "big")
+
+def distanza_hamming(hash1 : int, hash2 : int) -> int:
+   """Numero di bit diversi tra due hash."""
+   return bin(hash1 ^ hash2).count("1")
+
+class AlberoBK:
+   """BK-tree per la ricerca di hash entro una distanza di Hamming.
+      Ogni nodo contiene un hash, gli indici delle immagini con quell'hash ed i figli indicizzati
+      per distanza dal nodo. Per la disuguaglianza triangolare una ricerca entro distanza_max visita
+      solo i figli a distanza [d - distanza_max, d + distanza_max], quindi è sublineare per distanze piccole.
+   """
+
+   def __init__(self):
+      self._radice = None
+      self._n = 0
+
+   def __len__(self):
+      return self._n
+
+   def aggiungi(self, hash_immagine : int, indice):
+      """Inserisce l'hash di un'immagine, identificata da indice."""
+      self._n += 1
+      if self._radice is None:
+         self._radice = (hash_immagine, [indice], {})
+         return
+
+      nodo = self._radice
+      while True:
+         d = distanza_hamming(hash_immagine, nodo[0])
+         if d == 0:
+            nodo[1].append(indice)
+            return
+         if d not in nodo[2]:
+            nodo[2][d] = (hash_immagine, [indice], {})
+            return
+         nodo = nodo[2][d]
+
+   def cerca(self, hash_immagine : int, distanza_max : int) -> list:
+      """Restituisce la lista di (indice, distanza) delle immagini entro distanza_max bit."""
+      risultati = []
+      if self._radice is None:
+         return risultati
+
+      da_visitare = [self._radice]
+      while da_visitare:
+         hash_nodo, indici, figli = da_visitare.pop()
+         d = distanza_hamming(hash_immagine, hash_nodo)
+         if d <= distanza_max:
+            risultati.extend((indice, d) for indice in indici)
+         for distanza_figlio, figlio in figli.items():
+            if d - distanza_max <= distanza_figlio <= d + distanza_max:
+               da_visitare.append(figlio)
+      return risultati
+
+def _coppie_percettive(hashes : list, distanza_max : int) -> list:
+   """Date le coppie (indice, hash) restituisce le coppie di indici (i, j), i < j, entro distanza_max bit."""
+   albero = AlberoBK()
+   coppie = []
+   for i, hash_immagine in hashes:
+      for j, _ in albero.cerca(hash_immagine, distanza_max):
+         coppie.append((j, i))
+      albero.aggiungi(hash_immagine, i)
+   coppie.sort()
+   return coppie
+
+def _coppie_da_gruppi(gruppi) -> list:
+   """Dati dei gruppi di indici (immagini con lo stesso digest) restituisce tutte le coppie (i, j) con i < j,
+      nello stesso ordine del confronto a coppie."""
+   coppie = []
+   for indici in gruppi:
+      if len(indici) < 2:
+         continue
+      for a in range(len(indici)):
+         for b in range(a + 1, len(indici)):
+            coppie.append((indici[a], indici[b]))
+   coppie.sort()
+   return coppie
+
+def _fingerprint_file(file_path : str, tipo_controllo : str, tipo_hash : str) -> tuple:
+   """Calcola il digest ("duplicati") o l'hash percettivo ("percettivi") di un file.
+      Restituisce (fingerprint, None) oppure (None, messaggio di errore) se il file non si apre."""
+   try:
+      if tipo_controllo == "duplicati":
+         return digest_immagine(file_path), None
+      return hash_percettivo(file_path, tipo_hash=tipo_hash), None
+   except Exception as e:
+      return None, str(e)
+
+class IndiceFingerprint:
+   """Indice persistente (SQLite) dei fingerprint delle immagini: digest per "duplicati" e hash percettivi.
+      Ogni fingerprint è salvato con path, dimensione e mtime del file: alla scansione successiva vengono
+      ricalcolati solo i fingerprint dei file nuovi o modificati, per gli altri basta uno stat.
+
+      I file eliminati dalla cartella restano nell'indice finché non si chiama pota
+      (o immagini_uguali_in_cartella con pota_indice=True).
+
+      Si può usare come context manager:
+         with IndiceFingerprint("fingerprint.sqlite") as indice:
+            immagini_uguali_in_cartella(cartella, "duplicati", indice=indice)
+   """
+
+   def __init__(self, path_database : str):
+      if not isinstance(path_database,str):
+         raise TypeError("path_database deve essere una stringa")
+
+      self.path_database = path_database
+      self._connessione = sqlite3.connect(path_database)
+      self._connessione.execute("""CREATE TABLE IF NOT EXISTS fingerprint (
+                                      path TEXT NOT NULL,
+                                      tipo TEXT NOT NULL,
+                                      size INTEGER NOT NULL,
+                                      mtime_ns INTEGER NOT NULL,
+                                      valore BLOB NOT NULL,
+                                      PRIMARY KEY (path, tipo))""")
+      self._connessione.commit()
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, *args):
+      self.chiudi()
+
+   def __len__(self):
+      return self._connessione.execute("SELECT COUNT(*) FROM fingerprint").fetchone()[0]
+
+   def cerca(self, path_image : str, tipo : str, stat : os.stat_result):
+      """Restituisce il fingerprint salvato (bytes) se il file non è cambiato, altrimenti None."""
+      riga = self._connessione.execute("SELECT size, mtime_ns, valore FROM fingerprint WHERE path = ? AND tipo = ?",
+                                       (os.path.abspath(path_image), tipo)).fetchone()
+      if riga is None or riga[0] != stat.st_size or riga[1] != stat.st_mtime_ns:
+         return None
+      return riga[2]
+
+   def salva(self, righe : list):
+      """Salva una lista di (path, tipo, stat, valore) sostituendo i fingerprint precedenti."""
+      self._connessione.executemany("INSERT OR REPLACE INTO fingerprint VALUES (?, ?, ?, ?, ?)",
+                                    [(os.path.abspath(path_image), tipo, stat.st_size, stat.st_mtime_ns, valore)
+                                     for path_image, tipo, stat, valore in righe])
+      self._connessione.commit()
+
+   def pota(self,
+            path_directory : str,
+            path_visti : list,
+            ricorsivo : bool = False
+           ) -> int:
+      """Elimina i fingerprint dei file di path_directory (e delle sottocartelle se ricorsivo) che non sono
+         in path_visti, cioè dei file non più presenti nell'ultima scansione. Restituisce il numero di path eliminati."""
+      cartella = os.path.abspath(path_directory)
+      prefisso = os.path.join(cartella, "")
+      fine_prefisso = prefisso[:-1] + chr(ord(prefisso[-1]) + 1) # primo path dopo tutti quelli con il prefisso
+      visti = {os.path.abspath(path_image) for path_image in path_visti}
+
+      righe = self._connessione.execute("SELECT DISTINCT path FROM fingerprint WHERE path >= ? AND path < ?",
+                                        (prefisso, fine_prefisso)).fetchall()
+      da_eliminare = [(path,) for (path,) in righe
+                      if path not in visti and (ricorsivo or os.path.dirname(path) == cartella)]
+      self._connessione.executemany("DELETE FROM fingerprint WHERE path = ?", da_eliminare)
+      self._connessione.commit()
+      return len(da_eliminare)
+
+   def chiudi(self):
+      self._connessione.close()
+
+def _fingerprint_in_bytes(fingerprint) -> bytes:
+   """Digest e hash percettivi come bytes, per salvarli nell'indice."""
+   if isinstance(fingerprint, int):
+      return fingerprint.to_bytes(max(1, (fingerprint.bit_length() + 7) // 8), "big")
+   return fingerprint
+
+def _calcola_fingerprints(path_file : list,
+                          tipo_controllo : str,
+                          tipo_hash : str,
+                          n_jobs : int,
+                          indice : Union[IndiceFingerprint, None]
+                         ) -> list:
+   """Restituisce la lista di (indice file, fingerprint), saltando i file che non si aprono.
+      I fingerprint presenti nell'indice per file non modificati non vengono ricalcolati."""
+   tipo = "duplicati" if tipo_controllo == "duplicati" else f"percettivi:{tipo_hash}"
+
+   fingerprints = {}
+   stats = {}
+   da_calcolare = list(range(len(path_file)))
+   if indice is not None:
+      da_calcolare = []
+      for i, file_path in enumerate(path_file):
+         stats[i] = os.stat(file_path)
+         valore = indice.cerca(file_path, tipo, stats[i])
+         if valore is None:
+            da_calcolare.append(i)
+         elif tipo_controllo == "duplicati":
+            fingerprints[i] = valore
+         else:
+            fingerprints[i] = int.from_bytes(valore, "big")
+
+   argomenti = [(path_file[i], tipo_controllo, tipo_hash) for i in da_calcolare]
+   if n_jobs > 1:
+      risultati = _mappa_parallela(_fingerprint_file, argomenti, n_jobs)
+   else:
+      risultati = (_fingerprint_file(*a) for a in argomenti)
+
+   nuovi = []
+   for i, (fingerprint, errore) in zip(da_calcolare, risultati):
+      if errore is not None:
+         print(f"Errore nell'aprire {path_file[i]}: {errore}")
+         continue
+      fingerprints[i] = fingerprint
+      if indice is not None:
+         nuovi.append((path_file[i], tipo, stats[i], _fingerprint_in_bytes(fingerprint)))
+
+   if nuovi:
+      indice.salva(nuovi)
+
+   return sorted(fingerprints.items())
+
+def _applica_chunk(funzione, chunk : list) -> list:
+   """Applica funzione ad ogni elemento del chunk (eseguita nei processi worker)."""
+   return [funzione(*argomenti) for argomenti in chunk]
+
+def _mappa_parallela(funzione,
+                     argomenti : list,
+                     n_jobs : int,
+                     dimensione_chunk : int = 64,
+                     initializer = None,
+                     initargs : tuple = ()
+                    ):
+   """Applica funzione agli argomenti su un pool di processi e restituisce i risultati nello stesso ordine.
+      Gli argomenti sono divisi in chunk e al massimo 2 * n_jobs chunk sono in lavorazione
+      contemporaneamente, così la memoria resta limitata anche su cartelle molto grandi."""
+   with ProcessPoolExecutor(max_workers=n_jobs, initializer=initializer, initargs=initargs) as executor:
+      in_lavorazione = deque()
+      for inizio in range(0, len(argomenti), dimensione_chunk):
+         in_lavorazione.append(executor.submit(_applica_chunk, funzione, argomenti[inizio:inizio + dimensione_chunk]))
+         if len(in_lavorazione) >= 2 * n_jobs:
+            yield from in_lavorazione.popleft().result()
+      while in_lavorazione:
+         yield from in_lavorazione.popleft().result()
+
+def _n_jobs_effettivi(n_jobs : int) -> int:
+   """Numero di processi da usare, -1 per usare tutti i core."""
+   if not isinstance(n_jobs,int) or n_jobs == 0 or n_jobs < -1:
+      raise ValueError("n_jobs deve essere un intero positivo oppure -1")
+   if n_jobs == -1:
+      return os.cpu_count() or 1
+   return n_jobs
+
+# Variabili dei processi worker per il confronto "simili", impostate da _inizializza_worker_simili
+_path_file_worker = []
+_tolleranza_worker = 1e-5
+
+def _inizializza_worker_simili(path_file : list, tolleranza : float):
+   global _path_file_worker, _tolleranza_worker
+   _path_file_worker = path_file
+   _tolleranza_worker = tolleranza
+
+def _simili_riga(i : int) -> list:
+   """Indici j > i delle immagini simili all'immagine i (eseguita nei processi worker).
+      Senza cache: ogni processo avrebbe la propria cache_immagini e la memoria crescerebbe con n_jobs."""
+   return [j for j in range(i + 1, len(_path_file_worker))
+           if immagini_simili(_path_file_worker[i], _path_file_worker[j], tolleranza=_tolleranza_worker, cache=None)]
+
 def immagini_uguali_in_cartella( path_directory: str,
-                                 tipo_controllo: Literal["duplicati", "simili"],
+                                 tipo_controllo: Literal["duplicati", "simili", "percettivi", "simili_batch"],
                                  tolleranza : float =  1e-5,
+                                 verifica_pixel : bool = False,
+                                 distanza_max : int = 5,
+                                 tipo_hash : Literal["average", "difference", "dct"] = "difference",
+                                 n_jobs : int = 1,
+                                 indice : Union[IndiceFingerprint, str, None] = None,
+                                 pota_indice : bool = False,
                                ):
     """
     Confronta tutte le immagini in una cartella e trova immagini duplicate o simili.
 
+    Con "duplicati" ogni immagine viene decodificata una sola volta, se ne calcola il digest
+    (vedi digest_immagine) e le immagini vengono raggruppate per digest: il costo è lineare
+    nel numero di immagini invece che quadratico.
+
+    Con "percettivi" per ogni immagine si calcola una sola volta l'hash percettivo (vedi hash_percettivo)
+    e le coppie entro distanza_max bit si trovano con un BK-tree (AlberoBK), trovando anche immagini
+    ricodificate o leggermente ritagliate.
+
+    Con "simili_batch" il confronto con tolleranza avviene sulle thumbnail di tutte le immagini
+    in blocchi vettorizzati (vedi immagini_simili_batch).
+
     :param path_directory: Percorso della cartella contenente le immagini.
-    :param tipo_controllo: "duplicati" per confronto esatto, "simili" per confronto con tolleranza.
+    :param tipo_controllo: "duplicati" per confronto esatto, "simili" per confronto con tolleranza,
+                           "percettivi" per confronto tramite hash percettivo,
+                           "simili_batch" per confronto con tolleranza sulle thumbnail.
+    :param tolleranza: tolleranza usata con "simili" e "simili_batch".
+    :param verifica_pixel: con "duplicati", conferma ogni coppia trovata tramite digest con un confronto pixel by pixel.
+    :param distanza_max: con "percettivi", massimo numero di bit diversi tra gli hash di due immagini simili.
+    :param tipo_hash: con "percettivi", tipo di hash percettivo da usare.
+    :param n_jobs: numero di processi con cui decodificare e calcolare digest/hash (o confrontare le coppie
+                   con "simili"), -1 per usare tutti i core. Il risultato è identico a quello seriale.
+    :param indice: con "duplicati" e "percettivi", IndiceFingerprint (o path del database SQLite) in cui
+                   salvare i fingerprint: alle scansioni successive si ricalcolano solo i file nuovi o modificati.
+    :param pota_indice: con indice, elimina dall'indice i file della cartella non più presenti (vedi IndiceFingerprint.pota).
     :return: Lista di coppie di immagini uguali o simili.
     """
+    if not isinstance(verifica_pixel,bool):
+        raise TypeError("verifica_pixel deve essere un booleano")
+
+    if tipo_controllo not in ["duplicati", "simili", "percettivi", "simili_batch"]:
+        raise ValueError('tipo_controllo deve essere "duplicati", "simili", "percettivi" o "simili_batch"')
+
+    if not isinstance(distanza_max,int) or distanza_max < 0:
+        raise TypeError("distanza_max deve essere un intero non negativo")
+
+    if tipo_hash not in ["average", "difference", "dct"]:
+        raise ValueError('tipo_hash deve essere "average", "difference" o "dct"')
+
+    if indice is not None:
+        if not isinstance(indice, (str, IndiceFingerprint)):
+            raise TypeError("indice deve essere un IndiceFingerprint o il path (str) del database")
+        if tipo_controllo not in ["duplicati", "percettivi"]:
+            raise ValueError('indice si usa solo con tipo_controllo "duplicati" o "percettivi"')
+
+    if not isinstance(pota_indice,bool):
+        raise TypeError("pota_indice deve essere un booleano")
+
+    if pota_indice and indice is None:
+        raise ValueError("pota_indice richiede indice")
+
+    n_jobs = _n_jobs_effettivi(n_jobs)
+
     nomi_file = []
     path_file = []
     # Legge tutte le immagini nella cartella
@@ -133,59 +755,366 @@ def immagini_uguali_in_cartella( path_directory: str,
 
     immagini_duplicate = []
 
+    if tipo_controllo in ["duplicati", "percettivi"]:
+        # Un solo fingerprint (digest o hash percettivo) per immagine, calcolato in parallelo se n_jobs > 1
+        # e riutilizzato dall'indice per i file non modificati
+        indice_aperto = IndiceFingerprint(indice) if isinstance(indice, str) else indice
+        try:
+            fingerprints = _calcola_fingerprints(path_file, tipo_controllo, tipo_hash, n_jobs, indice_aperto)
+            if pota_indice:
+                indice_aperto.pota(path_directory, path_file)
+        finally:
+            if isinstance(indice, str):
+                indice_aperto.chiudi()
+
+    if tipo_controllo == "duplicati":
+        # Raggruppare le immagini per digest
+        gruppi = {}
+        for i, digest in fingerprints:
+            gruppi.setdefault(digest, []).append(i)
+
+        for i, j in _coppie_da_gruppi(gruppi.values()):
+            # Conferma opzionale della collisione con il confronto pixel by pixel
+            if verifica_pixel and not immagini_uguali(path_file[i],path_file[j]):
+                continue
+            immagini_duplicate.append((nomi_file[i],nomi_file[j]))
+
+        return immagini_duplicate
+
+    if tipo_controllo == "percettivi":
+        # Le coppie vicine si cercano nel BK-tree
+        for i, j in _coppie_percettive(fingerprints, distanza_max):
+            immagini_duplicate.append((nomi_file[i],nomi_file[j]))
+
+        return immagini_duplicate
+
+    if tipo_controllo == "simili_batch":
+        nomi_per_path = dict(zip(path_file, nomi_file))
+        for img1, img2 in immagini_simili_batch(path_file, tolleranza=tolleranza):
+            immagini_duplicate.append((nomi_per_path[img1],nomi_per_path[img2]))
+
+        return immagini_duplicate
+
+    if n_jobs > 1:
+        # Ogni processo confronta un'immagine con tutte le successive
+        righe = _mappa_parallela(_simili_riga, [(i,) for i in range(len(path_file))], n_jobs,
+                                 dimensione_chunk=1,
+                                 initializer=_inizializza_worker_simili,
+                                 initargs=(path_file, tolleranza))
+        for i, simili in enumerate(righe):
+            for j in simili:
+                immagini_duplicate.append((nomi_file[i],nomi_file[j]))
+
+        return immagini_duplicate
+
     # Confronta ogni coppia di immagini
     for i in range(len(nomi_file)):
         for j in range(i + 1, len(nomi_file)):
             img1,nome_img1 = path_file[i],nomi_file[i]
             img2,nome_img2 = path_file[j],nomi_file[j]
 
-            if tipo_controllo == "duplicati":
-                # Controllo esatto pixel per pixel
-                if immagini_uguali(img1,img2):
-                    immagini_duplicate.append((nome_img1,nome_img2))
-
-            elif tipo_controllo == "simili":
-                # Controllo con una tolleranza di differenza tra pixel
-                if immagini_simili(img1,img2,tolleranza=tolleranza):
-                    immagini_duplicate.append((nome_img1,nome_img2))
+            # Controllo con una tolleranza di differenza tra pixel
+            if immagini_simili(img1,img2,tolleranza=tolleranza):
+                immagini_duplicate.append((nome_img1,nome_img2))
 
     return immagini_duplicate
 
+# Estensioni considerate immagini da trova_immagini_uguali_iter
+ESTENSIONI_IMMAGINI = (".png", ".jpg", ".jpeg", ".bmp", ".gif", ".tif", ".tiff", ".webp")
+
+def _scandisci_immagini(path_directory : str, ricorsivo : bool, estensioni : tuple):
+   """Genera i path dei file con estensione immagine, visitando le sottocartelle con os.scandir se ricorsivo."""
+   da_visitare = [path_directory]
+   while da_visitare:
+      cartella = da_visitare.pop()
+      with os.scandir(cartella) as elementi:
+         sottocartelle = []
+         for elemento in elementi:
+            if elemento.is_dir(follow_symlinks=False):
+               sottocartelle.append(elemento.path)
+            elif elemento.is_file() and elemento.name.lower().endswith(estensioni):
+               yield elemento.path
+      if ricorsivo:
+         da_visitare.extend(reversed(sorted(sottocartelle)))
+
+def trova_immagini_uguali_iter(path_directory: str,
+                               tipo_controllo: Literal["duplicati", "simili", "percettivi"],
+                               tolleranza : float =  1e-5,
+                               distanza_max : int = 5,
+                               tipo_hash : Literal["average", "difference", "dct"] = "difference",
+                               ricorsivo : bool = True,
+                               estensioni : tuple = ESTENSIONI_IMMAGINI,
+                              ):
+    """
+    Versione generatore di immagini_uguali_in_cartella: visita la cartella (e le sottocartelle se ricorsivo)
+    con os.scandir, considera solo i file con estensione in estensioni, senza aprire gli altri, e restituisce
+    ogni coppia appena viene trovata.
+
+    Per "duplicati" e "percettivi" in memoria restano solo i fingerprint già visti (digest o hash percettivo),
+    mai i pixel; per "simili" ogni nuova immagine viene confrontata con quelle già viste.
+
+    :param path_directory: Percorso della cartella contenente le immagini.
+    :param tipo_controllo: "duplicati", "simili" o "percettivi", come in immagini_uguali_in_cartella.
+    :param tolleranza: tolleranza usata con "simili".
+    :param distanza_max: con "percettivi", massimo numero di bit diversi tra gli hash.
+    :param tipo_hash: con "percettivi", tipo di hash percettivo da usare.
+    :param ricorsivo: se visitare anche le sottocartelle.
+    :param estensioni: estensioni (minuscole) dei file da considerare.
+    :return: Generatore di coppie (path relativo immagine già vista, path relativo nuova immagine).
+    """
+    if not isinstance(ricorsivo,bool):
+        raise TypeError("ricorsivo deve essere un booleano")
+
+    if tipo_controllo not in ["duplicati", "simili", "percettivi"]:
+        raise ValueError('tipo_controllo deve essere "duplicati", "simili" o "percettivi"')
+
+    if not isinstance(distanza_max,int) or distanza_max < 0:
+        raise TypeError("distanza_max deve essere un intero non negativo")
+
+    if tipo_hash not in ["average", "difference", "dct"]:
+        raise ValueError('tipo_hash deve essere "average", "difference" o "dct"')
+
+    estensioni = tuple(estensione.lower() for estensione in estensioni)
+
+    gruppi = {}
+    albero = AlberoBK()
+    visti = []
+    for file_path in _scandisci_immagini(path_directory, ricorsivo, estensioni):
+        nome = os.path.relpath(file_path, path_directory)
+
+        if tipo_controllo == "simili":
+            for file_visto, nome_visto in visti:
+                if immagini_simili(file_visto,file_path,tolleranza=tolleranza):
+                    yield (nome_visto, nome)
+            visti.append((file_path, nome))
+            continue
+
+        fingerprint, errore = _fingerprint_file(file_path, tipo_controllo, tipo_hash)
+        if errore is not None:
+            print(f"Errore nell'aprire {file_path}: {errore}")
+            continue
+
+        if tipo_controllo == "duplicati":
+            gruppo = gruppi.setdefault(fingerprint, [])
+            for nome_visto in gruppo:
+                yield (nome_visto, nome)
+            gruppo.append(nome)
+        else:
+            for nome_visto, _ in albero.cerca(fingerprint, distanza_max):
+                yield (nome_visto, nome)
+            albero.aggiungi(fingerprint, nome)
+
 def get_image_hash(image_array):
     """Calcola un hash per l'immagine."""
     image_bytes = image_array.tobytes()  # Converte l'immagine in una sequenza di byte
     return hashlib.md5(image_bytes).hexdigest()  # Genera l'hash MD5
 
-def immagini_uguali_tensorflow_data(dataset1,dataset2):
+def hash_batch(images : np.ndarray,
+               buffer : Union[np.ndarray, None] = None
+              ) -> tuple:
+   """
+   Calcola un hash a 128 bit (blake2b) per ogni immagine di un batch con valori in [0, 1].
+   Le immagini vengono convertite in uint8 (come (img * 255).astype(np.uint8)) direttamente dentro buffer,
+   senza temporanei float, poi ogni riga del buffer viene passata a hashlib.blake2b senza copie.
+   Immagini uguali hanno sempre lo stesso hash.
+
+   Prende in input:
+      - images (np.ndarray): batch di immagini, la prima dimensione è il batch
+      - buffer (np.ndarray) opzionale: buffer uint8 restituito da una chiamata precedente, per riutilizzarlo
+
+   Output:
+      - hashes (np.ndarray): array uint64 (batch, 2), i 16 byte del digest letti little endian
+      - buffer (np.ndarray): il buffer usato, da passare alla chiamata successiva
+   """
+   images = np.asarray(images)
+   n_immagini = images.shape[0]
+   n_byte = int(np.prod(images.shape[1:]))
+
+   if buffer is None or buffer.shape[0] < n_immagini or buffer.shape[1] != n_byte:
+      buffer = np.empty((n_immagini, n_byte), dtype=np.uint8)
+
+   righe = buffer[:n_immagini]
+   np.multiply(images.reshape(n_immagini, n_byte), 255, out=righe, casting="unsafe")
+
+   digest = b"".join(hashlib.blake2b(riga, digest_size=16).digest() for riga in righe)
+   hashes = np.frombuffer(digest, dtype="<u8").reshape(n_immagini, 2)
+   return hashes, buffer
+
+def _batch_con_prefetch(dataset):
+   """Genera (immagini, nomi file) per ogni batch del dataset, caricando il batch successivo
+      in un thread in background mentre si lavora su quello corrente."""
+   n_batch = len(dataset)
+   if n_batch == 0:
+      return
+
+   with ThreadPoolExecutor(max_workers=1) as executor:
+      prossimo = executor.submit(dataset.__getitem__, 0)
+      for i in range(n_batch):
+         images, _ = prossimo.result() # Ignoriamo le etichette
+         if i + 1 < n_batch:
+            prossimo = executor.submit(dataset.__getitem__, i + 1)
+         filenames = dataset.filenames[i * dataset.batch_size : (i + 1) * dataset.batch_size]
+         yield images, filenames
+
+def immagini_uguali_tensorflow_data(dataset1,
+                                    dataset2,
+                                    verbose : bool = True
+                                   ) -> list:
+   """
+   Trova le immagini del dataset2 (es. test) uguali ad immagini del dataset1 (es. train).
+   I dataset sono iteratori a batch di tensorflow/keras (es. flow_from_directory) con attributi filenames e batch_size.
+
+   Ogni batch viene convertito ed hashato in blocco con hash_batch (riutilizzando lo stesso buffer),
+   mentre il batch successivo viene caricato in background.
+
+   Prende in input:
+      - dataset1, dataset2: iteratori a batch
+      - verbose (bool): stampare il riepilogo delle immagini duplicate
+
+   Output:
+      Lista di coppie (file dataset2, file dataset1) di immagini duplicate.
+   """
+   if not isinstance(verbose,bool):
+      raise TypeError("verbose deve essere un booleano")
+
    # Ottieni gli hash delle immagini nel train set con i nomi dei file
    train_hashes = {}
-   for i in range(len(dataset1)):
-      images, _ = dataset1[i]  # Ignoriamo le etichette
-      filenames = dataset1.filenames[i * dataset1.batch_size : (i + 1) * dataset1.batch_size]
-      
-      for img, filename in zip(images, filenames):
-         img_hash = get_image_hash((img * 255).astype(np.uint8))  # Converti i valori di pixel a [0, 255]
-         if img_hash in train_hashes:
-               train_hashes[img_hash].append(filename)  # Aggiungi il file duplicato alla lista
-         else:
-               train_hashes[img_hash] = [filename]  # Crea una nuova lista con il primo file
+   buffer = None
+   for images, filenames in _batch_con_prefetch(dataset1):
+      hashes, buffer = hash_batch(images, buffer)
+      for img_hash, filename in zip(hashes, filenames):
+         train_hashes.setdefault(img_hash.tobytes(), []).append(filename)
 
    # Controlla le immagini nel test set
    duplicate_files = []
-   for i in range(len(dataset2)):
-      images, _ = dataset2[i]
-      filenames = dataset2.filenames[i * dataset2.batch_size : (i + 1) * dataset2.batch_size]
-
-      for img, filename in zip(images, filenames):
-         img_hash = get_image_hash((img * 255).astype(np.uint8))
-         if img_hash in train_hashes:
-               for train_file in train_hashes[img_hash]:  # Controlla tutti i duplicati
-                  duplicate_files.append((filename, train_file))  # Salva ogni coppia duplicata
+   for images, filenames in _batch_con_prefetch(dataset2):
+      hashes, buffer = hash_batch(images, buffer)
+      for img_hash, filename in zip(hashes, filenames):
+         for train_file in train_hashes.get(img_hash.tobytes(), []):  # Controlla tutti i duplicati
+            duplicate_files.append((filename, train_file))  # Salva ogni coppia duplicata
 
    # Stampa i risultati
-   if duplicate_files:
-      print(f"Attenzione! Sono state trovate {len(duplicate_files)} immagini duplicate tra train e test.")
-      for test_file, train_file in duplicate_files:
-         print(f"Dataset 1: {test_file}  <->  Dataset 2: {train_file}")
+   if verbose:
+      if duplicate_files:
+         print(f"Attenzione! Sono state trovate {len(duplicate_files)} immagini duplicate tra train e test.")
+         for test_file, train_file in duplicate_files:
+            print(f"Dataset 1: {test_file}  <->  Dataset 2: {train_file}")
+      else:
+         print("Nessuna immagine duplicata tra train e test.")
+
+   return duplicate_files
+
+def fingerprint_corpus(sorgente,
+                       ricorsivo : bool = False
+                      ) -> tuple:
+   """
+   Calcola un fingerprint a 64 bit per ogni immagine di un corpus.
+   sorgente può essere il path di una cartella (fingerprint = primi 8 byte di digest_immagine, nomi = path relativi)
+   oppure un iteratore a batch tensorflow/keras come in immagini_uguali_tensorflow_data
+   (fingerprint = primi 8 byte del digest blake2b di hash_batch, nomi = filenames).
+   I due tipi di fingerprint non sono confrontabili tra loro.
+
+   Output:
+      - fingerprint (np.ndarray): array uint64, uno per immagine, nell'ordine dei nomi
+      - nomi (list): nomi delle immagini
+   """
+   if isinstance(sorgente, str):
+      nomi = []
+      fingerprint = []
+      for file_path in _scandisci_immagini(sorgente, ricorsivo, ESTENSIONI_IMMAGINI):
+         digest, errore = _fingerprint_file(file_path, "duplicati", "difference")
+         if errore is not None:
+            print(f"Errore nell'aprire {file_path}: {errore}")
+            continue
+         nomi.append(os.path.relpath(file_path, sorgente))
+         fingerprint.append(int.from_bytes(digest[:8], "little"))
+      return np.array(fingerprint, dtype=np.uint64), nomi
+
+   nomi = []
+   blocchi = []
+   buffer = None
+   for images, filenames in _batch_con_prefetch(sorgente):
+      hashes, buffer = hash_batch(images, buffer)
+      # primi 8 byte del digest, letti little endian come per le cartelle
+      blocchi.append(hashes[:, 0].astype(np.uint64))
+      nomi.extend(filenames)
+   fingerprint = np.concatenate(blocchi) if blocchi else np.empty(0, dtype=np.uint64)
+   return fingerprint, nomi
+
+def ordina_fingerprint(fingerprint : np.ndarray) -> tuple:
+   """Restituisce (fingerprint ordinati, posizioni originali), le posizioni nel più piccolo dtype intero possibile."""
+   ordine = np.argsort(fingerprint, kind="stable")
+   dtype = np.uint32 if len(fingerprint) < 2**32 else np.uint64
+   return fingerprint[ordine], ordine.astype(dtype)
+
+def salva_fingerprint(path_base : str,
+                      fingerprint : np.ndarray,
+                      nomi : list):
+   """Salva su disco i fingerprint ordinati di un corpus: path_base.fingerprint.npy, path_base.ordine.npy
+      e path_base.nomi.txt (un nome per riga). Si ricaricano, anche memory-mapped, con carica_fingerprint."""
+   ordinati, ordine = ordina_fingerprint(np.asarray(fingerprint, dtype=np.uint64))
+   np.save(f"{path_base}.fingerprint.npy", ordinati)
+   np.save(f"{path_base}.ordine.npy", ordine)
+   with open(f"{path_base}.nomi.txt", "w", encoding="utf-8") as file:
+      file.writelines(f"{nome}\n" for nome in nomi)
+
+def carica_fingerprint(path_base : str, mmap : bool = True) -> tuple:
+   """Carica i fingerprint salvati da salva_fingerprint.
+      Con mmap i due array restano su disco (np.load con mmap_mode="r").
+
+      Output:
+         - fingerprint ordinati, posizioni originali, nomi
+   """
+   mmap_mode = "r" if mmap else None
+   ordinati = np.load(f"{path_base}.fingerprint.npy", mmap_mode=mmap_mode)
+   ordine = np.load(f"{path_base}.ordine.npy", mmap_mode=mmap_mode)
+   with open(f"{path_base}.nomi.txt", encoding="utf-8") as file:
+      nomi = file.read().splitlines()
+   return ordinati, ordine, nomi
+
+def _corpus_ordinato(sorgente) -> tuple:
+   """Restituisce (fingerprint ordinati, posizioni originali, nomi) per una sorgente di trova_leakage."""
+   if isinstance(sorgente, tuple):
+      if len(sorgente) == 3:
+         return sorgente
+      fingerprint, nomi = sorgente
    else:
-      print("Nessuna immagine duplicata tra train e test.")
+      fingerprint, nomi = fingerprint_corpus(sorgente)
+   ordinati, ordine = ordina_fingerprint(np.asarray(fingerprint, dtype=np.uint64))
+   return ordinati, ordine, nomi
+
+def trova_leakage(sorgente1, sorgente2) -> list:
+   """
+   Trova le immagini di sorgente2 (es. test) uguali ad immagini di sorgente1 (es. train) tramite un join
+   vettorizzato (np.searchsorted) tra array ordinati di fingerprint a 64 bit: in memoria restano pochi byte
+   per immagine invece di un dizionario di stringhe.
+
+   Ogni sorgente può essere:
+      - il path di una cartella o un iteratore a batch (vedi fingerprint_corpus)
+      - una tupla (fingerprint, nomi) restituita da fingerprint_corpus
+      - una tupla (fingerprint ordinati, posizioni, nomi) restituita da carica_fingerprint, anche memory-mapped
+
+   Output:
+      Lista di coppie (nome sorgente2, nome sorgente1), nell'ordine di sorgente2 e poi di sorgente1.
+   """
+   ordinati1, ordine1, nomi1 = _corpus_ordinato(sorgente1)
+   ordinati2, ordine2, nomi2 = _corpus_ordinato(sorgente2)
+
+   # Per ogni fingerprint di sorgente2 l'intervallo di fingerprint uguali in sorgente1
+   inizio = np.searchsorted(ordinati1, ordinati2, side="left")
+   fine = np.searchsorted(ordinati1, ordinati2, side="right")
+   conteggi = fine - inizio
+   totale = int(conteggi.sum())
+   if totale == 0:
+      return []
+
+   # Espandere gli intervalli in coppie di posizioni
+   indici2 = np.repeat(np.arange(len(ordinati2)), conteggi)
+   spostamenti = np.arange(totale) - np.repeat(np.cumsum(conteggi) - conteggi, conteggi)
+   indici1 = np.repeat(inizio, conteggi) + spostamenti
+
+   posizioni2 = np.asarray(ordine2)[indici2].astype(np.int64)
+   posizioni1 = np.asarray(ordine1)[indici1].astype(np.int64)
+   ordine_coppie = np.lexsort((posizioni1, posizioni2))
+
+   return [(nomi2[posizioni2[k]], nomi1[posizioni1[k]]) for k in ordine_coppie]